@@ -1,18 +1,29 @@
 """Extract text data from Breeding Bird Census pdfs"""
 
+import argparse
+import hashlib
 import os
+import pickle
 import re
 import string
+import time
+from array import array
+from collections import Counter
 from glob import glob
 from functools import lru_cache
+from multiprocessing import Pool
 
 import pandas as pd
-from fuzzywuzzy import fuzz, process
+from fuzzywuzzy import fuzz
+
+import combined_files
+import instrumentation
+from combined_files import get_site_pages, load_index, site_header_regex
+from instrumentation import count, timed
 
 def get_site(inputstring):
     """Check if line is location data and if so return location"""
-    site_re = "^([0-9]{1,2})\. ([A-Z —-]{2,})"
-    site_search = re.search(site_re, inputstring)
+    site_search = site_header_regex.search(inputstring)
     if site_search:
         return (site_search.group(1), site_search.group(2))
 
@@ -20,117 +31,133 @@ def is_start_main_block(inputstring):
     """Check if line is the first line of the main block of data"""
     return inputstring.startswith("Location: ") or inputstring.startswith('Site Number: ')
 
+@instrumentation.profiled
+def apply_replacements(text, replacements, hits=None):
+    """Apply a table of literal replacements to text in table order
+
+    If hits is a Counter the number of replacements made by each rule is added
+    to it.
+
+    """
+    for key, value in replacements.items():
+        if key in text:
+            if hits is not None:
+                hits[key] += text.count(key)
+            text = text.replace(key, value)
+    return text
+
+# Cleanup difficult issues manually
+# Combination of difficult \n's and OCR mistakes
+block_replacements = {'Cemus': 'Census',
+                      'Description of plot': 'Description of Plot',
+                      'Description Oi Plot': 'Description of Plot',
+                      'Acknowledgmentsz': 'Acknowledgments: ',
+                      'Other Observers:]': 'Other Observers: ',
+                      'Other 0berservers': 'Other Observers: ',
+                      '0ther Observerers': 'Other Observers: ',
+                      'Other 0bservers': 'Other Observers: ',
+                      'Other Observers.': 'Other Observers:',
+                      'Other Observers]': 'Other Observers:',
+                      'Continnity': 'Continuity',
+                      'lViagnolia': 'Magnolia',
+                      'lVildlife': 'Wildlife',
+                      'Mallard ): American Black Duck hybrid': 'Mallard x American Black Duck hybrid',
+                      'Observerszj': 'Observers',
+                      'Bobolink; 9.0 territories': 'Bobolink, 9.0 territories',
+                      "37°38'N, 121°46lW": "37°38'N, 121°46'W",
+                      'Common Yellowthroat, 4.5, Northern Flicker, 3.0': 'Common Yellowthroat, 4.5; Northern Flicker, 3.0',
+                      'Red-bellied Woodpecker, 2.0, Carolina Chickadee, 2.0': 'Red-bellied Woodpecker, 2.0; Carolina Chickadee, 2.0',
+                      'Winter 1992': ' ', #One header line in one file got OCR'd for some reason
+                      'nuLquu “1:10': ' ',
+                      'nululuu 1:1:1.)': ' ',
+                      '20.9 h; 8 Visits (8 sunrise), 8, 15, 22, 29 April; 6, 13, 20, 27 May.': '20.9 h; 8 Visits (8 sunrise); 8, 15, 22, 29 April; 6, 13, 20, 27 May.',
+                      '19.3 h; 11 visits (11 sunrise;': '19.3 h; 11 visits (11 sunrise);',
+                      'Foster Plantation; 42"7’N': 'Foster Plantation; 42°7’N',
+                      'Hermit Thrush, 4.5 (18), Black-throatcd Green Warbler': 'Hermit Thrush, 4.5 (18); Black-throated Green Warbler', # Fixes both delimiter and selling of throated
+                      '39"] 2‘N, 76°54’W': '39°12‘N, 76°54’W',
+                      "42°“7'N, 77°45’W": "42°7'N, 77°45’W",
+                      '41°4\'N, 76"7’W': "41°4'N, 76°7’W",
+                      'w‘sits': 'visits',
+                      '79513’W': '79°13’W',
+                      'Continuity.': 'Continuity:',
+                      'Continuity"': 'Continuity:',
+                      "40°44'N, 7 D50’W": "40°44'N, 75°50’W",
+                      "41350'N, 71°33'W": "41°50'N, 71°33'W",
+                      '44°57’N, 68D41’W': '44°57’N, 68°41’W',
+                      '18.8 11; 11 Visits': '18.8 h; 11 Visits',
+                      "Descripn'on of Plot": "Description of Plot",
+                      '41 c’42’N, 73°13’VV': "41°42'N, 73°13'W",
+                      'Northern Rough-winged Swallow. 0.5': 'Northern Rough-winged Swallow, 0.5',
+                      'Warbling Vireo, 1.0, Northern Cardinal, 1.0': 'Warbling Vireo, 1.0; Northern Cardinal, 1.0',
+                      'Wood Thrush, 3.0 (18), American Redstart, 3.0': 'Wood Thrush, 3.0; American Redstart, 3.0',
+                      'study-hrs': 'study-hours',
+                      'studyhours': 'study-hours',
+                      'Nuttall’s Woodpecker, 3 (9; 2N),':'Nuttall’s Woodpecker, 3 (9; 2N);',
+                      '38°35’45”N\', 76°45’46"W': '38°35’45”N, 76°45’46"W',
+                      'Northern Parula 8': 'Northern Parula, 8',
+                      '47°08’N, 99°] 5’ W': '47°08’N, 99°15’ W',
+                      'Yellow Warbler, 1,’ Clay-colored Sparrow, 1,Savannah Sparrow, 1;': 'Yellow Warbler, 1; Clay-colored Sparrow, 1; Savannah Sparrow, 1;',
+                      'Established 1993; 2 )n‘.': 'Established 1993; 2.',
+                      'Established l983': 'Established 1983',
+                      'Established 1978; 18 you': 'Established 1978; 18 yr.',
+                      'This plot is part of a larger plot that was ﬁrst censused in 1981.': '',
+                      'Ruby-throatcd Hummingbird': 'Ruby-throated Hummingbird',
+                      'RuHed Grouse': 'Ruffed Grouse',
+                      '\Varbler': "Warbler",
+                      'VVarbler': "Warbler",
+                      'Common Yellowthroat 3': 'Common Yellowthroat, 3',
+                      'all known to breed in immediate vicinity': '',
+                      'and a number of vagrants': '',
+                      "Utner Ubservers": "Other Observers",
+                      'Dovmy': 'Downy',
+                      "W'oodpecker": "Woodpecker",
+                      "\700d Thrush": "Wood Thrush",
+                      "\form-eating Warbler": "Worm-eating Warbler",
+                      "Cliﬂ' Swallow": "Cliff Swallow",
+                      'Cliﬂ\ Swallow"': 'Cliff Swallow',
+                      'Downy Woodpecknululuu I JHJ er': 'Downy Woodpecker',
+                      'unidentiﬁed Accipiter': 'Accipiter sp.',
+                      "Traill’s Flycatcher": "Willow Flycatcher",
+                      'Eastern Titmouse': 'Tufted Titmouse',
+                      'Common Barn Owl': 'Barn Owl',
+                      'Common Bushtit': 'Bushtit',
+                      'Yellow-shafted Flicker': 'Northern Flicker',
+                      'Yellowshafted Flicker': 'Northern Flicker',
+                      'Common Barn-Owl': 'Barn Owl',
+                      'Northern Parula Warbler': 'Northern Parula',
+                      'Yellow-rumped,': 'Yellow-rumped Warbler,',
+                      'Common Crow': 'American Crow',
+                      ', Raven,': ', Common Raven,',
+                      '; Raven,': '; Common Raven,',
+                      '+_': '+',
+                      'chickadee sp.;': 'chickadee sp.,',
+                      'Yellow Warbler, 0.5, Common Yellowthroat, 0.5.': 'Yellow Warbler, 0.5; Common Yellowthroat, 0.5.',
+                      'Whip-poor-will, 1.0, European Starling, 1.0': 'Whip-poor-will, 1.0; European Starling, 1.0',
+                      '80(9\'45"': '80°9\'45"',
+                      'American Crow; 1.0;': 'American Crow, 1.0;',
+                      "47°08'N7 99°15'W;": "47°08'N 99°15'W;",
+                      "', 7'6°45": ", 76°45",
+                      "43°] 6’N": "43°16'N",
+                      "121°461W": "121°46'W",
+                      "39.] h;": "39.1 h;",
+                      "74°ll": "74°11",
+                      "40°] 1": "40°11",
+                      "Estao lished": "Established",
+                      "Estabo lished": "Established",
+                      "Estab lished": "Established",
+                      "79°O": "79°0",
+                      "79°]": "79°1",
+                      "12.] h;": "12.1 h;",
+                      "terﬁtories": "territories"
+}
+
+replacement_hits = Counter()
+
+@instrumentation.profiled
 def parse_block(block, site_name, site_num, year):
     """Parse a main data block from a BBC file"""
-    # Cleanup difficult issues manually
-    # Combination of difficult \n's and OCR mistakes
-    replacements = {'Cemus': 'Census',
-                    'Description of plot': 'Description of Plot',
-                    'Description Oi Plot': 'Description of Plot',
-                    'Acknowledgmentsz': 'Acknowledgments: ',
-                    'Other Observers:]': 'Other Observers: ',
-                    'Other 0berservers': 'Other Observers: ',
-                    '0ther Observerers': 'Other Observers: ',
-                    'Other 0bservers': 'Other Observers: ',
-                    'Other Observers.': 'Other Observers:',
-                    'Other Observers]': 'Other Observers:',
-                    'Continnity': 'Continuity',
-                    'lViagnolia': 'Magnolia',
-                    'lVildlife': 'Wildlife',
-                    'Mallard ): American Black Duck hybrid': 'Mallard x American Black Duck hybrid',
-                    'Observerszj': 'Observers',
-                    'Bobolink; 9.0 territories': 'Bobolink, 9.0 territories',
-                    "37°38'N, 121°46lW": "37°38'N, 121°46'W",
-                    'Common Yellowthroat, 4.5, Northern Flicker, 3.0': 'Common Yellowthroat, 4.5; Northern Flicker, 3.0',
-                    'Red-bellied Woodpecker, 2.0, Carolina Chickadee, 2.0': 'Red-bellied Woodpecker, 2.0; Carolina Chickadee, 2.0',
-                    'Winter 1992': ' ', #One header line in one file got OCR'd for some reason
-                    'nuLquu “1:10': ' ',
-                    'nululuu 1:1:1.)': ' ',
-                    '20.9 h; 8 Visits (8 sunrise), 8, 15, 22, 29 April; 6, 13, 20, 27 May.': '20.9 h; 8 Visits (8 sunrise); 8, 15, 22, 29 April; 6, 13, 20, 27 May.',
-                    '19.3 h; 11 visits (11 sunrise;': '19.3 h; 11 visits (11 sunrise);',
-                    'Foster Plantation; 42"7’N': 'Foster Plantation; 42°7’N',
-                    'Hermit Thrush, 4.5 (18), Black-throatcd Green Warbler': 'Hermit Thrush, 4.5 (18); Black-throated Green Warbler', # Fixes both delimiter and selling of throated
-                    '39"] 2‘N, 76°54’W': '39°12‘N, 76°54’W',
-                    "42°“7'N, 77°45’W": "42°7'N, 77°45’W",
-                    '41°4\'N, 76"7’W': "41°4'N, 76°7’W",
-                    'w‘sits': 'visits',
-                    '79513’W': '79°13’W',
-                    'Continuity.': 'Continuity:',
-                    'Continuity"': 'Continuity:',
-                    "40°44'N, 7 D50’W": "40°44'N, 75°50’W",
-                    "41350'N, 71°33'W": "41°50'N, 71°33'W",
-                    '44°57’N, 68D41’W': '44°57’N, 68°41’W',
-                    '18.8 11; 11 Visits': '18.8 h; 11 Visits',
-                    "Descripn'on of Plot": "Description of Plot",
-                    '41 c’42’N, 73°13’VV': "41°42'N, 73°13'W",
-                    'Northern Rough-winged Swallow. 0.5': 'Northern Rough-winged Swallow, 0.5',
-                    'Warbling Vireo, 1.0, Northern Cardinal, 1.0': 'Warbling Vireo, 1.0; Northern Cardinal, 1.0',
-                    'Wood Thrush, 3.0 (18), American Redstart, 3.0': 'Wood Thrush, 3.0; American Redstart, 3.0',
-                    'study-hrs': 'study-hours',
-                    'studyhours': 'study-hours',
-                    'Nuttall’s Woodpecker, 3 (9; 2N),':'Nuttall’s Woodpecker, 3 (9; 2N);',
-                    '38°35’45”N\', 76°45’46"W': '38°35’45”N, 76°45’46"W',
-                    'Northern Parula 8': 'Northern Parula, 8',
-                    '47°08’N, 99°] 5’ W': '47°08’N, 99°15’ W',
-                    'Yellow Warbler, 1,’ Clay-colored Sparrow, 1,Savannah Sparrow, 1;': 'Yellow Warbler, 1; Clay-colored Sparrow, 1; Savannah Sparrow, 1;',
-                    'Established 1993; 2 )n‘.': 'Established 1993; 2.',
-                    'Established l983': 'Established 1983',
-                    'Established 1978; 18 you': 'Established 1978; 18 yr.',
-                    'This plot is part of a larger plot that was ﬁrst censused in 1981.': '',
-                    'Ruby-throatcd Hummingbird': 'Ruby-throated Hummingbird',
-                    'RuHed Grouse': 'Ruffed Grouse',
-                    '\Varbler': "Warbler",
-                    'VVarbler': "Warbler",
-                    'Common Yellowthroat 3': 'Common Yellowthroat, 3',
-                    'all known to breed in immediate vicinity': '',
-                    'and a number of vagrants': '',
-                    "Utner Ubservers": "Other Observers",
-                    'Dovmy': 'Downy',
-                    "W'oodpecker": "Woodpecker",
-                    "\700d Thrush": "Wood Thrush",
-                    "\form-eating Warbler": "Worm-eating Warbler",
-                    "Cliﬂ' Swallow": "Cliff Swallow",
-                    'Cliﬂ\ Swallow"': 'Cliff Swallow',
-                    'Downy Woodpecknululuu I JHJ er': 'Downy Woodpecker',
-                    'unidentiﬁed Accipiter': 'Accipiter sp.',
-                    "Traill’s Flycatcher": "Willow Flycatcher",
-                    'Eastern Titmouse': 'Tufted Titmouse',
-                    'Common Barn Owl': 'Barn Owl',
-                    'Common Bushtit': 'Bushtit',
-                    'Yellow-shafted Flicker': 'Northern Flicker',
-                    'Yellowshafted Flicker': 'Northern Flicker',
-                    'Common Barn-Owl': 'Barn Owl',
-                    'Northern Parula Warbler': 'Northern Parula',
-                    'Yellow-rumped,': 'Yellow-rumped Warbler,',
-                    'Common Crow': 'American Crow',
-                    ', Raven,': ', Common Raven,',
-                    '; Raven,': '; Common Raven,',
-                    '+_': '+',
-                    'chickadee sp.;': 'chickadee sp.,',
-                    'Yellow Warbler, 0.5, Common Yellowthroat, 0.5.': 'Yellow Warbler, 0.5; Common Yellowthroat, 0.5.',
-                    'Whip-poor-will, 1.0, European Starling, 1.0': 'Whip-poor-will, 1.0; European Starling, 1.0',
-                    '80(9\'45"': '80°9\'45"',
-                    'American Crow; 1.0;': 'American Crow, 1.0;',
-                    "47°08'N7 99°15'W;": "47°08'N 99°15'W;",
-                    "', 7'6°45": ", 76°45",
-                    "43°] 6’N": "43°16'N",
-                    "121°461W": "121°46'W",
-                    "39.] h;": "39.1 h;",
-                    "74°ll": "74°11",
-                    "40°] 1": "40°11",
-                    "Estao lished": "Established",
-                    "Estabo lished": "Established",
-                    "Estab lished": "Established",
-                    "79°O": "79°0",
-                    "79°]": "79°1",
-                    "12.] h;": "12.1 h;",
-                    "terﬁtories": "territories"
-    }
     block = get_cleaned_string(block)
-    for replacement in replacements:
-        if replacement in block:
-            print("Replacing {} with {}".format(replacement, replacements[replacement]))
-            block = block.replace(replacement, replacements[replacement])
+    block = apply_replacements(block, block_replacements, replacement_hits)
     block = get_clean_block(block)
     p = re.compile(r'((?:Site Number|Location|Continuity|Previously called|Size|Description of Plot|Edge|Topography and Elevation|Weather|Coverage|Census|Fledglings|Nests and Fledglings|Fledglings Seen|Fledglings Noted|Total|Visitors|Nests Found|Remarks|Observers|Other Observers|Other Observer|Acknowledgments)):')
     split_block = p.split(block)[1:] #discard first value; an empty string
@@ -139,33 +166,57 @@ def parse_block(block, site_name, site_num, year):
     block_dict['SiteNumInCensus'] = site_num * 10000 + year
     return block_dict
 
-def parse_txt_file(infile, year):
-    """Parse a BBC text file"""
-    first_site = True
+def iter_sites(infile, year):
+    """Yield the site number and parsed main block for each site in a BBC file
+
+    Each site is parsed as soon as the next site header (or the end of the
+    file) is reached, so only the lines of one site are held in memory.
+
+    """
+    site_num = None
+    block_lines = []
     recording = False
-    data = dict()
+    # time spent splitting the file into blocks, excluding parse_block
+    start = time.perf_counter()
     for line in infile:
         site_info = get_site(line)
         if site_info:
-            if not first_site:
-                data[site_num] = parse_block(main_block, site_name, site_num, year)
-            first_site = False
+            if block_lines:
+                instrumentation.add_timing('split_blocks', time.perf_counter() - start,
+                                           year=year)
+                with timed('parse_block', year=year, site=site_num):
+                    site_data = parse_block(''.join(block_lines), site_name, site_num, year)
+                yield site_num, site_data
+                start = time.perf_counter()
             site_num, site_name = site_info
             site_name = site_name.replace('—', '-')
             site_num = int(site_num)
+            block_lines = []
             recording = False
         elif is_start_main_block(line):
-            main_block = ''
+            block_lines = []
             recording = True
         if recording:
             if line.strip():
-                main_block += line
+                block_lines.append(line)
+    instrumentation.add_timing('split_blocks', time.perf_counter() - start, year=year)
+    if block_lines:
+        with timed('parse_block', year=year, site=site_num):
+            site_data = parse_block(''.join(block_lines), site_name, site_num, year)
+        yield site_num, site_data
+
+def parse_txt_file(infile, year):
+    """Parse a BBC text file"""
+    data = dict()
+    for site_num, site_data in iter_sites(infile, year):
+        data[site_num] = site_data
     return(data)
 
+latlong_regex = re.compile("""([0-9]{1,2})[ ]*[º°˚05CD']([0-9]{1,2}) *[’|'|‘][0-9]{0,2}["|”]{0,1} *N,*[ |\\n]([0-9]{2,3})[ ]*[º°˚05CD']([0-9]{1,2})[ ]*[’|'|‘| ][0-9]{0,2}["|”]{0,1} *[W|V|;|.]""")
+
 def get_latlong(location):
     """Extract the latitude and longitude from the Location data"""
-    regex =  """([0-9]{1,2})[ ]*[º°˚05CD']([0-9]{1,2}) *[’|'|‘][0-9]{0,2}["|”]{0,1} *N,*[ |\\n]([0-9]{2,3})[ ]*[º°˚05CD']([0-9]{1,2})[ ]*[’|'|‘| ][0-9]{0,2}["|”]{0,1} *[W|V|;|.]"""
-    search = re.search(regex, location)
+    search = latlong_regex.search(location)
     if search:
         lat_deg, lat_min = int(search.group(1)), int(search.group(2))
         long_deg, long_min = int(search.group(3)), int(search.group(4))
@@ -173,8 +224,13 @@ def get_latlong(location):
         long_decdeg = long_deg + long_min / 60.0
         return (lat_decdeg, long_decdeg)
 
+@instrumentation.profiled
 def extract_counts(data, year):
-    """Split the Census text block into species and counts"""
+    """Split the Census text block into species and counts
+
+    Returns a list of rows for the counts table
+
+    """
     census_data = data['Census']
     census_data = re.sub(r'\([^)]+\)', '', census_data) # remove parentheticals (which include ;)
     census_data = census_data.replace('territories', '')
@@ -217,32 +273,28 @@ def extract_counts(data, year):
                                  None, 'visitor']
                 counts_results.append(counts_record)
 
-    counts_data = pd.DataFrame(counts_results, columns=['year',
-                                                        'siteNumInCensus',
-                                                        'species',
-                                                        'count',
-                                                        'status'])
+    counts_data = [dict(zip(['year', 'siteNumInCensus', 'species', 'count',
+                             'status'], record))
+                   for record in counts_results]
     return counts_data
 
+unicode_replacements = {'ﬁ': 'fi',
+                        'ﬂ': 'fi',
+                        '—': '-',
+                        "’": "'",
+                        "‘": "'",
+                        '”': '"',
+                        '“': '"',
+                        'km3': 'km2',
+                        'kmz': 'km2',
+                        '\\N': 'W',
+                        'VV': 'W',
+                        'lVI': 'M',
+                        '\x0c': ''}
+
 def get_clean_block(block):
     """Clean up unicode characters and common OCR errors in blocks"""
-    replacements = {'ﬁ': 'fi',
-                    'ﬂ': 'fi',
-                    '—': '-',
-                    "’": "'",
-                    "‘": "'",
-                    '”': '"',
-                    '“': '"',
-                    'km3': 'km2',
-                    'kmz': 'km2',
-                    '\\N': 'W',
-                    'VV': 'W',
-                    'lVI': 'M',
-                    '\x0c': ''}
-    for replacement in replacements:
-        if replacement in block:
-            block = block.replace(replacement, replacements[replacement])
-    return(block)
+    return apply_replacements(block, unicode_replacements, replacement_hits)
 
 def get_clean_size(size_data):
     """Remove units, notes, and whitespace"""
@@ -251,6 +303,20 @@ def get_clean_size(size_data):
     size = size.replace(' ', '') # Sometimes OCR adds a space
     return float(size.strip(' .\n'))
 
+# Valid species names, known aliases and fuzzy matching diagnostics used by
+# get_cleaned_species
+species_index = None
+species_aliases = {}
+unmatched = []
+matched = {}
+
+def set_valid_species(valid_names, aliases=None):
+    """Set the valid species names and aliases used by get_cleaned_species"""
+    global species_index, species_aliases
+    species_index = build_species_index(valid_names)
+    species_aliases = aliases if aliases is not None else {}
+    get_cleaned_species.cache_clear()
+
 @lru_cache(maxsize=None)
 def get_cleaned_species(species):
     """Cleanup species names"""
@@ -260,9 +326,17 @@ def get_cleaned_species(species):
     species = species.replace('species', 'sp.')
     species = species.strip(' .')
     species = re.sub(r'\([^)]+\)', '', species) #remove parenthetical
-    matched_species = process.extractOne(species, valid_sp_names,
-                                         processor=str, # Needed to hack around https://github.com/seatgeek/fuzzywuzzy/issues/77
-                                         scorer=fuzz.ratio)
+    if species in species_aliases:
+        count('species_alias_hits')
+        cleaned_name, score, source = species_aliases[species]
+        if source == 'fuzzy':
+            # keep reporting earlier fuzzy matches for error checking
+            matched[species] = (cleaned_name, score)
+        return cleaned_name
+    with timed('fuzzy_match'):
+        matched_species = match_species(species, species_index)
+    count('fuzzy_match_calls')
+    count('fuzzy_match_scores', score=matched_species[1])
     if matched_species[1] >= 70:
         if matched_species[1] < 100:
             matched[species] = matched_species
@@ -272,6 +346,55 @@ def get_cleaned_species(species):
         species = None
     return species
 
+def build_species_index(valid_names):
+    """Index valid species names by length and character counts for matching"""
+    species_index = {'names': valid_names, 'exact': set(valid_names),
+                     'by_length': dict()}
+    for position, name in enumerate(valid_names):
+        species_index['by_length'].setdefault(len(name), []).append(
+            (position, name, Counter(name)))
+    return species_index
+
+def get_ratio_bound(matches, total_length):
+    """Upper bound on fuzz.ratio for strings sharing at most `matches` characters"""
+    return int(round(100 * (2.0 * matches / total_length)))
+
+@instrumentation.profiled
+def match_species(species, species_index):
+    """Find the best matching valid species name and its fuzz.ratio score
+
+    Gives the same result as process.extractOne with processor=str and
+    scorer=fuzz.ratio, but only scores names that could beat the best match so
+    far. fuzz.ratio can't exceed 2 * shared characters / total length, so names
+    are visited in order of decreasing length bound and skipped when their
+    character counts can't reach the current best score. Ties go to the name
+    earliest in the list, as with extractOne.
+
+    """
+    names = species_index['names']
+    if not species:
+        return (names[0], 0)
+    # Only identical strings round to 100 unless names are ~200 characters
+    if species in species_index['exact'] and len(species) < 100:
+        return (species, 100)
+    species_counts = Counter(species)
+    species_len = len(species)
+    length_bounds = sorted(species_index['by_length'],
+                           key=lambda length: -min(species_len, length) / (species_len + length))
+    best_score, best_position = -1, len(names)
+    for length in length_bounds:
+        total_length = species_len + length
+        if get_ratio_bound(min(species_len, length), total_length) < best_score:
+            break
+        for position, name, name_counts in species_index['by_length'][length]:
+            shared = sum((species_counts & name_counts).values())
+            bound = get_ratio_bound(shared, total_length)
+            if bound < best_score or (bound == best_score and position > best_position):
+                continue
+            score = fuzz.ratio(species, name)
+            if score > best_score or (score == best_score and position < best_position):
+                best_score, best_position = score, position
+    return (names[best_position], best_score)
 
 def get_cleaned_string(string_data):
     """Do basic cleanup on string data
@@ -297,20 +420,25 @@ def clean_string_fields(site_data):
             site_data[field] = get_cleaned_string(site_data[field])
     return site_data
 
-def extract_coverage(coverage):
+# Coverage regexes for each format as (with visits, without visits). Up to
+# 1988 visits come before study-hours, afterwards hours come first.
+coverage_regexes = {
+    'modern': (re.compile('([0-9]{1,3}\.{0,1}[0-9]{0,2}) h; ([0-9]{1,2}) Visits(.*)', re.IGNORECASE),
+               re.compile('([0-9]{1,3}\.{0,1}[0-9]{0,2}) h', re.IGNORECASE)),
+    '1988': (re.compile('([0-9]{1,3}) Visits; ([0-9]{1,3}) study[-|—]hours;(.*)', re.IGNORECASE),
+             re.compile('([0-9]{1,3}) study[-|—]hours[;. ](.*)', re.IGNORECASE))}
+
+def get_coverage_format(year):
+    """Get the name of the Coverage format used in a year"""
+    return 'modern' if year > 1988 else '1988'
+
+def extract_coverage(coverage, year):
     """Extract number of hours and number of visits from Coverage"""
     coverage = get_cleaned_string(coverage)
     extracted = dict()
-    re_modern = '([0-9]{1,3}\.{0,1}[0-9]{0,2}) h; ([0-9]{1,2}) Visits(.*)'
-    re_modern_no_visits = '([0-9]{1,3}\.{0,1}[0-9]{0,2}) h'
-    re_1988 = '([0-9]{1,3}) Visits; ([0-9]{1,3}) study[-|—]hours;(.*)'
-    re_1988_no_visits = '([0-9]{1,3}) study[-|—]hours[;. ](.*)'
-    if year > 1988:
-        search = re.search(re_modern, coverage, re.IGNORECASE)
-        search_no_visits = re.search(re_modern_no_visits, coverage, re.IGNORECASE)
-    else:
-        search = re.search(re_1988, coverage, re.IGNORECASE)
-        search_no_visits = re.search(re_1988_no_visits, coverage, re.IGNORECASE)
+    regex, regex_no_visits = coverage_regexes[get_coverage_format(year)]
+    search = regex.search(coverage)
+    search_no_visits = regex_no_visits.search(coverage)
     if search:
         extracted['hours'] = float(search.group(1))
         extracted['visits'] = int(search.group(2))
@@ -321,23 +449,26 @@ def extract_coverage(coverage):
         extracted['notes'] = None
     return extracted
 
+total_regex = re.compile('([0-9]{1,3}) species[;|,] ([0-9 ]{1,4}\.{0,1}[0-9]{0,1}) (territories|territorial males)[;|,]* \(([^)]+)\)', re.IGNORECASE)
+
 def extract_total(total):
     """Extract the total number of species and total territories"""
     total = get_cleaned_string(total)
     extracted = dict()
-    regex = '([0-9]{1,3}) species[;|,] ([0-9 ]{1,4}\.{0,1}[0-9]{0,1}) (territories|territorial males)[;|,]* \(([^)]+)\)'
-    search = re.search(regex, total, re.IGNORECASE)
+    search = total_regex.search(total)
     extracted['total_species'] = int(search.group(1))
     extracted['total_territories'] = float(search.group(2).replace(' ', ''))
     extracted['total_terr_notes'] = search.group(4)
     return extracted
 
+parenthetical_regex = re.compile('\(([^)]+)\)')
+continuity_removals = ['Established', 'years', 'yrs', 'yr', 'consecutive', 'intermittent']
+
 def extract_continuity(continuity, year):
     """Extract establishment year and number of years surveyed"""
     continuity = get_cleaned_string(continuity)
-    continuity = re.sub('\(([^)]+)\)', '', continuity)
-    removals = ['Established', 'years', 'yrs', 'yr', 'consecutive', 'intermittent']
-    for removal in removals:
+    continuity = parenthetical_regex.sub('', continuity)
+    for removal in continuity_removals:
         continuity = continuity.replace(removal, '').strip(' \n.')
     extracted = dict()
     if 'New' in continuity:
@@ -360,51 +491,458 @@ def extract_continuity(continuity, year):
         extracted['length'] = int(length) if length else None
     return extracted
 
-def extract_site_data(site_data):
-    """Extract data for a site"""
-    site_data['Latitude'], site_data['Longitude'] = get_latlong(site_data['Location'])
+def extract_field(site_data, field, extract, year, failed_rows, empty):
+    """Extract a field of a site, or record it as failed and return empty
+
+    Without a failed_rows list the error is raised instead
+
+    """
+    try:
+        extracted = extract(site_data.get(field))
+        if extracted is None:
+            raise ValueError("Couldn't parse {}: {!r}".format(field, site_data.get(field)))
+        return extracted
+    except (AttributeError, TypeError, ValueError):
+        if failed_rows is None:
+            raise
+        failed_rows.append({'year': year, 'site': site_data['SiteNumInCensus'],
+                            'field': field, 'value': site_data.get(field)})
+        return empty
+
+@instrumentation.profiled
+def extract_site_data(site_data, year, failed_rows=None):
+    """Extract data for a site
+
+    If a failed_rows list is given, Location, Coverage, Total and Continuity
+    fields that can't be parsed are left empty and added to it instead of
+    raising
+
+    """
+    site_data['Latitude'], site_data['Longitude'] = extract_field(
+        site_data, 'Location', get_latlong, year, failed_rows, (None, None))
     site_data['Size'] = get_clean_size(site_data['Size'])
     if 'Coverage' in site_data:
-        site_data['Coverage'] = extract_coverage(site_data['Coverage'])
+        site_data['Coverage'] = extract_field(
+            site_data, 'Coverage', lambda coverage: extract_coverage(coverage, year),
+            year, failed_rows, dict())
     else:
         site_data['Coverage'] = dict()
-    site_data['Total'] = extract_total(site_data['Total'])
-    site_data['Continuity'] = extract_continuity(site_data['Continuity'], year)
+    site_data['Total'] = extract_field(
+        site_data, 'Total', extract_total, year, failed_rows,
+        {'total_species': None, 'total_territories': None, 'total_terr_notes': None})
+    site_data['Continuity'] = extract_field(
+        site_data, 'Continuity', lambda continuity: extract_continuity(continuity, year),
+        year, failed_rows, {'established': None, 'length': None})
     site_data = clean_string_fields(site_data)
     return site_data
 
-def get_sites_table(site_data):
-    """Put site level data into a dataframe"""
-    sites_table = pd.DataFrame({'siteNumInCensus': [site_data['SiteNumInCensus']],
-                                'sitename': [site_data['SiteName']],
-                                'latitude': [site_data['Latitude']],
-                                'longitude': [site_data['Longitude']],
-                                'location': [site_data['Location']],
-                                'description': [site_data['Description of Plot']]})
-    return sites_table
-
-def get_census_table(site_data, year):
-    """Put census level data into a dataframe"""
+def get_sites_row(site_data):
+    """Put site level data into a row for the sites table"""
+    sites_row = {'siteNumInCensus': site_data['SiteNumInCensus'],
+                 'sitename': site_data['SiteName'],
+                 'latitude': site_data['Latitude'],
+                 'longitude': site_data['Longitude'],
+                 'location': site_data['Location'],
+                 'description': site_data['Description of Plot']}
+    return sites_row
+
+def get_census_row(site_data, year):
+    """Put census level data into a row for the census table"""
     #sometimes Weather doesn't exist before 1989
     weather = site_data['Weather'] if 'Weather' in site_data else None
     previously_called = site_data['Previously called'] if 'Previously called' in site_data else None
-    census_table = pd.DataFrame({'sitename': [site_data['SiteName']],
-                                 'siteNumInCensus': [site_data['SiteNumInCensus']],
-                                 'year': [year],
-                                 'established': [site_data['Continuity']['established']],
-                                 'ts_length': [site_data['Continuity']['length']],
-                                 'cov_hours': [site_data['Coverage'].get('hours', None)],
-                                 'cov_visits': [site_data['Coverage'].get('visits', None)],
-                                 'cov_times': [site_data['Coverage'].get('times', None)],
-                                 'cov_notes': [site_data['Coverage'].get('notes', None)],
-                                 'area': [site_data['Size']],
-                                 'richness': [site_data['Total']['total_species']],
-                                 'territories': [site_data['Total']['total_territories']],
-                                 'terr_notes': [site_data['Total']['total_terr_notes']],
-                                 'weather': [weather],
-                                 'previously_called': [previously_called]
-                             })
-    return census_table
+    census_row = {'sitename': site_data['SiteName'],
+                  'siteNumInCensus': site_data['SiteNumInCensus'],
+                  'year': year,
+                  'established': site_data['Continuity']['established'],
+                  'ts_length': site_data['Continuity']['length'],
+                  'cov_hours': site_data['Coverage'].get('hours', None),
+                  'cov_visits': site_data['Coverage'].get('visits', None),
+                  'cov_times': site_data['Coverage'].get('times', None),
+                  'cov_notes': site_data['Coverage'].get('notes', None),
+                  'area': site_data['Size'],
+                  'richness': site_data['Total']['total_species'],
+                  'territories': site_data['Total']['total_territories'],
+                  'terr_notes': site_data['Total']['total_terr_notes'],
+                  'weather': weather,
+                  'previously_called': previously_called}
+    return census_row
+
+# Column types for the output tables. int64 columns are buffered in arrays,
+# everything else in lists, and each table is only built once at the end.
+counts_schema = {'siteNumInCensus': 'int64', 'year': 'int64',
+                 'species': 'category', 'count': 'object',
+                 'status': 'category'}
+sites_schema = {'siteNumInCensus': 'int64', 'sitename': 'object',
+                'latitude': 'float64', 'longitude': 'float64',
+                'location': 'object', 'description': 'object'}
+census_schema = {'sitename': 'object', 'siteNumInCensus': 'int64',
+                 'year': 'int64', 'established': 'Int64',
+                 'ts_length': 'Int64', 'cov_hours': 'float64',
+                 'cov_visits': 'Int64', 'cov_times': 'object',
+                 'cov_notes': 'object', 'area': 'float64',
+                 'richness': 'Int64', 'territories': 'float64',
+                 'terr_notes': 'object', 'weather': 'object',
+                 'previously_called': 'object'}
+
+def new_table_buffer(schema):
+    """Create empty column buffers for a table"""
+    return {column: array('q') if dtype == 'int64' else []
+            for column, dtype in schema.items()}
+
+def append_rows(table_buffer, rows):
+    """Add rows (dicts keyed by column) to a table's column buffers"""
+    for row in rows:
+        for column, values in table_buffer.items():
+            values.append(row[column])
+
+def build_table(table_buffer, schema):
+    """Build a typed dataframe from a table's column buffers"""
+    return pd.DataFrame({column: pd.Series(table_buffer[column], dtype=dtype)
+                         for column, dtype in schema.items()})
+
+# A site-year is linked to a site from another year when both coordinates are
+# within link_distance degrees (to allow for OCR errors in the minutes) and the
+# names are alike (see get_name_score). Sites are bucketed into a grid of
+# link_distance cells so only sites in neighbouring cells are compared.
+link_distance = 1.5 / 60
+# fuzz.ratio is 200 * matching characters / total length, so a misread letter
+# costs 10 points in a 10 letter name and 5 in a 20 letter one: 85 allows one
+# OCR error in a short name and a few in a long one. A habitat word added to a
+# name can score as much though: "COASTAL FRESHWATER MARSH", a different plot
+# from "FRESHWATER MARSH", scores 80 against it. So names scoring
+# link_name_score link, and names scoring link_prefix_score only link when the
+# shorter one starts the longer one, as when a name was cut short or a suffix
+# like "AND FIELD" was added in another year.
+link_name_score = 85
+link_prefix_score = 80
+
+def get_grid_cell(latitude, longitude):
+    """Get the grid cell a site falls in"""
+    return (int(latitude // link_distance), int(longitude // link_distance))
+
+def get_link_candidates(grid, latitude, longitude):
+    """Yield the sites in the grid cell of a location and the cells around it"""
+    row, column = get_grid_cell(latitude, longitude)
+    for cell in [(row + i, column + j) for i in (-1, 0, 1) for j in (-1, 0, 1)]:
+        yield from grid.get(cell, [])
+
+def get_site_key(sitename, latitude, longitude):
+    """Get the (sitename, latitude, longitude) a site-year is listed under, with None for missing coordinates"""
+    return (sitename, None if pd.isna(latitude) else latitude,
+            None if pd.isna(longitude) else longitude)
+
+def get_name_score(sitename, other_name):
+    """Get the fuzz.ratio of two site names, or None if they are too different to link"""
+    if sitename == other_name:
+        return 100
+    score = fuzz.ratio(sitename, other_name)
+    shorter, longer = sorted([sitename, other_name], key=len)
+    if score >= link_name_score or (score >= link_prefix_score and
+                                    longer.startswith(shorter)):
+        return score
+    return None
+
+def get_year_links(key, grid, sites_by_name):
+    """Get the (rank, other_num, score, distance) of each earlier site-year a site-year could join
+
+    A lower rank is a better match: the highest name score, then the nearest
+    and most recent. Sites without coordinates only match an identical name,
+    the most recent first.
+
+    """
+    sitename, latitude, longitude = key
+    candidates = []
+    if latitude is not None and longitude is not None:
+        for other_order, other_num, other_name, other_latitude, other_longitude in \
+                get_link_candidates(grid, latitude, longitude):
+            distance = max(abs(latitude - other_latitude), abs(longitude - other_longitude))
+            if distance > link_distance:
+                continue
+            score = get_name_score(sitename, other_name)
+            if score is None:
+                continue
+            candidates.append(((-score, distance, -(other_num % 10000), other_order),
+                               other_num, score, distance))
+    else:
+        for other_order, other_num in sites_by_name.get(sitename, []):
+            candidates.append(((-100, 0, -(other_num % 10000), -other_order),
+                               other_num, 100, None))
+    return candidates
+
+def get_exact_distance(key):
+    """Get the distance of a link between site-years listed under the same key, None without coordinates"""
+    return None if key[1] is None or key[2] is None else 0
+
+def get_link(site_num, other_num, score, distance):
+    """Describe a link from a site-year to an earlier one for the report"""
+    if distance is None:
+        match = 'name'
+    elif score == 100 and distance == 0:
+        match = 'exact'
+    else:
+        match = 'fuzzy'
+    return {'siteNumInCensus': site_num, 'linked_to': other_num, 'match': match,
+            'name_score': score,
+            'distance_minutes': None if distance is None else round(distance * 60, 2)}
+
+def link_sites(site_years, previous_site_ids=None):
+    """Give each site-year a siteID, linking the same plot across years
+
+    site_years is an iterable of (siteNumInCensus, sitename, latitude,
+    longitude) in year order. Site-years listed under the same (sitename,
+    latitude, longitude) always share a site. The rest of a year's site-years
+    are linked once the candidates for the whole year are known: the best
+    ranked candidates (see get_year_links) are taken first, so a fuzzy match
+    can't take the site of a better match listed after it, and a site never
+    gets a second census in the same year from a fuzzy or name match.
+
+    Sites are numbered in the order they first appear. Site-years found in
+    previous_site_ids ({siteNumInCensus: siteID}, e.g. from an earlier run)
+    keep their siteID, and new sites are numbered after them.
+
+    Returns {siteNumInCensus: siteID} and a list of the links made.
+
+    """
+    grid = dict()
+    sites_by_name = dict()
+    sites_by_key = dict()
+    key_of = dict()
+    site_of = dict()
+    site_years_of = []
+    links = []
+
+    def join_site(site_nums, site, other_num=None, score=None, distance=None):
+        site_years_of[site].add(site_nums[0] % 10000)
+        for site_num in site_nums:
+            site_of[site_num] = site
+            if other_num is not None:
+                links.append(get_link(site_num, other_num, score, distance))
+
+    years = dict()
+    for order, (site_num, sitename, latitude, longitude) in enumerate(site_years):
+        key = get_site_key(sitename, latitude, longitude)
+        key_of[site_num] = key
+        years.setdefault(site_num % 10000, dict()).setdefault(key, []).append((order, site_num))
+
+    for year, groups in years.items():
+        candidates = []
+        for key, members in groups.items():
+            site_nums = [site_num for order, site_num in members]
+            if key in sites_by_key:
+                other_num = sites_by_key[key]
+                join_site(site_nums, site_of[other_num], other_num, 100,
+                          get_exact_distance(key))
+                continue
+            # ties on rank go to the site-year listed first, so keys are never compared
+            for rank, other_num, score, distance in get_year_links(key, grid, sites_by_name):
+                candidates.append((rank, members[0][0], key, other_num, score, distance))
+        for rank, order, key, other_num, score, distance in sorted(candidates):
+            site_nums = [site_num for order, site_num in groups[key]]
+            site = site_of[other_num]
+            if site_nums[0] in site_of or year in site_years_of[site]:
+                continue
+            join_site(site_nums, site, other_num, score, distance)
+        for key, members in groups.items():
+            site_nums = [site_num for order, site_num in members]
+            if site_nums[0] not in site_of:
+                site_years_of.append(set())
+                join_site(site_nums[:1], len(site_years_of) - 1)
+                if len(site_nums) > 1:
+                    join_site(site_nums[1:], site_of[site_nums[0]], site_nums[0], 100,
+                              get_exact_distance(key))
+            sitename, latitude, longitude = key
+            for order, site_num in members:
+                sites_by_key[key] = site_num
+                if latitude is not None and longitude is not None:
+                    grid.setdefault(get_grid_cell(latitude, longitude), []).append(
+                        (order, site_num, sitename, latitude, longitude))
+                else:
+                    sites_by_name.setdefault(sitename, []).append((order, site_num))
+
+    # Number the sites, keeping previous siteIDs where there are any
+    previous_site_ids = previous_site_ids or dict()
+    members = [[] for _ in site_years_of]
+    for site_num, site in site_of.items():
+        members[site].append(site_num)
+    next_id = max(previous_site_ids.values(), default=0) + 1
+    used_ids = set()
+    ids = []
+    for site_nums in members:
+        previous = sorted(set(previous_site_ids[site_num] for site_num in site_nums
+                              if site_num in previous_site_ids) - used_ids)
+        if previous:
+            ids.append(previous[0])
+        else:
+            ids.append(next_id)
+            next_id += 1
+        used_ids.add(ids[-1])
+    site_ids = {site_num: ids[site] for site_num, site in site_of.items()}
+
+    # Site-years listed under the same (sitename, latitude, longitude) were one
+    # site before sites were linked, so linking must never split them
+    ids_of_key = dict()
+    for site_num, key in key_of.items():
+        ids_of_key.setdefault(key, set()).add(site_ids[site_num])
+    split = [key for key, key_ids in ids_of_key.items() if len(key_ids) > 1]
+    if split:
+        raise ValueError("Site-years with the same name and location got different "
+                         "siteIDs: {}".format(split))
+    for link in links:
+        link['siteID'] = site_ids[link['siteNumInCensus']]
+    return site_ids, links
+
+def load_site_ids(census_file):
+    """Load the siteID of each siteNumInCensus from an earlier census table"""
+    if not os.path.exists(census_file):
+        return dict()
+    census = pd.read_csv(census_file, usecols=['siteID', 'siteNumInCensus'])
+    return dict(zip(census['siteNumInCensus'].tolist(), census['siteID'].tolist()))
+
+def process_year(year, data_path):
+    """Parse a year's combined text file into rows for each table
+
+    The fuzzy matching and replacement diagnostics are reset and returned
+    with the rows, along with any fields that couldn't be parsed, so that
+    years can be processed in separate workers and merged back in year order
+    with the same result as a serial run.
+
+    """
+    get_cleaned_species.cache_clear()
+    matched.clear()
+    del unmatched[:]
+    replacement_hits.clear()
+    instrumentation.reset_report()
+    print("\nProcessing {} data...\n".format(year))
+    results = {'counts': [], 'sites': [], 'censuses': []}
+    datafile = os.path.join(data_path, "bbc_combined_{}.txt".format(year))
+    failed_rows = []
+    with timed('process_year', year=year), open(datafile) as infile:
+        for site_num, site_data in iter_sites(infile, year):
+            with timed('extract_site_data', year=year, site=site_num):
+                site_data = extract_site_data(site_data, year, failed_rows)
+            with timed('extract_counts', year=year, site=site_num):
+                results['counts'].extend(extract_counts(site_data, year))
+            results['sites'].append(get_sites_row(site_data))
+            results['censuses'].append(get_census_row(site_data, year))
+            count('sites', year=year)
+    # Trace failed rows back to their pdf page if the file has been indexed
+    index = load_index(datafile)
+    site_pages = get_site_pages(index) if index else dict()
+    for failed_row in failed_rows:
+        failed_row['page'] = site_pages.get(failed_row['site'] // 10000)
+        count('failed_rows', year=year, field=failed_row['field'])
+    cache_info = get_cleaned_species.cache_info()
+    count('species_cache_hits', cache_info.hits, year=year)
+    count('species_cache_misses', cache_info.misses, year=year)
+    count('replacement_hits', sum(replacement_hits.values()), year=year)
+    results['matched'] = dict(matched)
+    results['unmatched'] = list(unmatched)
+    results['replacement_hits'] = Counter(replacement_hits)
+    results['failed_rows'] = failed_rows
+    results['report'] = instrumentation.get_report()
+    return results
+
+def get_year_checkpoint_key(year, data_path, valid_names, name_corrections):
+    """Get a hash of everything that affects the parsed data for a year
+
+    Covers the year's text, the replacement tables, the valid species names and
+    corrections, and the code of this script and of combined_files.py, which
+    splits the text into sites. Fuzzy matches in the alias table aren't
+    included since they give the same result as matching again.
+
+    """
+    checkpoint_hash = hashlib.sha256()
+    checkpoint_hash.update(str(year).encode('utf-8'))
+    datafile = os.path.join(data_path, "bbc_combined_{}.txt".format(year))
+    with open(datafile, 'rb') as infile:
+        checkpoint_hash.update(infile.read())
+    checkpoint_hash.update(repr(list(block_replacements.items())).encode('utf-8'))
+    checkpoint_hash.update(repr(list(unicode_replacements.items())).encode('utf-8'))
+    checkpoint_hash.update(repr(list(valid_names)).encode('utf-8'))
+    checkpoint_hash.update(repr(list(name_corrections.items())).encode('utf-8'))
+    for code_file in [__file__, combined_files.__file__]:
+        with open(os.path.abspath(code_file), 'rb') as code:
+            checkpoint_hash.update(code.read())
+    return checkpoint_hash.hexdigest()
+
+def load_year_checkpoint(checkpoint_dir, year, key):
+    """Load the saved results for a year if its checkpoint is up to date"""
+    checkpoint = os.path.join(checkpoint_dir, "bbc_{}.pickle".format(year))
+    if not os.path.exists(checkpoint):
+        return None
+    with open(checkpoint, 'rb') as infile:
+        saved = pickle.load(infile)
+    if saved['key'] != key:
+        return None
+    return saved['results']
+
+def save_year_checkpoint(checkpoint_dir, year, key, results):
+    """Save the results for a year along with the key they were built from"""
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoint = os.path.join(checkpoint_dir, "bbc_{}.pickle".format(year))
+    with open(checkpoint + '.tmp', 'wb') as outfile:
+        pickle.dump({'key': key, 'results': results}, outfile)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+def get_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Extract data from the BBC text files")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help="number of years to process at once "
+                             "(default: number of cores)")
+    parser.add_argument('--checkpoint-dir', default="./cache/years/",
+                        help="directory for the parsed results of each year "
+                             "(default: %(default)s)")
+    parser.add_argument('--no-checkpoints', action='store_true',
+                        help="reprocess every year even if it hasn't changed")
+    parser.add_argument('--columnar', choices=['parquet', 'feather'],
+                        help="also write year partitioned tables in this format "
+                             "to output/columnar/ (requires pyarrow)")
+    parser.add_argument('--report', default="./reports/bbc-text-mining.json",
+                        help="file to write the timings, counters and fuzzy "
+                             "matching diagnostics to (default: %(default)s)")
+    parser.add_argument('--profile',
+                        help="profile the hot functions with cProfile and save the "
+                             "stats to this file (runs with --jobs 1 --no-checkpoints)")
+    parser.add_argument('--site-ids', default="./output/bbc_censuses.csv",
+                        help="census table from an earlier run whose siteIDs are kept "
+                             "for the same site-years (default: %(default)s)")
+    parser.add_argument('--aliases', default="./cache/species_aliases.csv",
+                        help="table of raw species names and their cleaned names, "
+                             "updated with each run's fuzzy matches "
+                             "(default: %(default)s)")
+    return parser.parse_args()
+
+# Columns with many repeated values that are dictionary encoded in columnar output
+dictionary_columns = {'bbc_counts': ['species', 'status'],
+                      'bbc_censuses': ['sitename', 'weather'],
+                      'bbc_sites': ['sitename', 'location', 'description']}
+
+def write_columnar_tables(tables, output_dir, file_format='parquet'):
+    """Write the output tables as year partitioned Parquet or Feather datasets
+
+    Each table is written to its own directory under output_dir, split into
+    year=<year> partitions if it has a year column, and can be read with e.g.
+    pyarrow.dataset.dataset(path, format=file_format, partitioning='hive').
+    Feather files are uncompressed so they can be memory-mapped.
+
+    Requires pyarrow.
+
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    for name, table in tables.items():
+        table = table.copy()
+        for column in dictionary_columns.get(name, []):
+            table[column] = table[column].astype('category')
+        arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+        partitioning = None
+        if 'year' in table:
+            partitioning = ds.partitioning(pa.schema([('year', pa.int64())]), flavor='hive')
+        ds.write_dataset(arrow_table, os.path.join(output_dir, name),
+                         format=file_format, partitioning=partitioning,
+                         existing_data_behavior='delete_matching')
 
 def get_valid_sp_names(sp_names_file):
     """Get valid species names from name corrections file"""
@@ -414,61 +952,187 @@ def get_valid_sp_names(sp_names_file):
     valid_names = list(names_data['cleaned_name'].drop_duplicates())
     return(valid_names)
 
-data_path = "./data/"
-valid_sp_names = get_valid_sp_names("data/bbc_species_corrections.csv")
-unmatched = []
-matched = {}
+def get_name_corrections(sp_names_file):
+    """Get the cleaned name for each original name in the name corrections file
 
-counts_table = pd.DataFrame(columns = ['siteNumInCensus', 'year', 'species',
-                                       'count', 'status'])
-site_table = pd.DataFrame(columns = ['siteNumInCensus', 'sitename', 'latitude',
-                                     'longitude', 'location', 'description'])
-census_table = pd.DataFrame(columns = ['sitename', 'siteNumInCensus',
-                                       'year', 'established', 'ts_length', 'cov_hours',
-                                       'cov_visits', 'cov_times', 'cov_notes', 'area',
-                                       'richness', 'territories', 'terr_notes',
-                                       'weather'])
-years = list(range(1988, 1996)) + list(range(2003, 2010))
-
-for year in years:
-    print("\nProcessing {} data...\n".format(year))
-    datafile = os.path.join(data_path, "bbc_combined_{}.txt".format(year))
-    with open(datafile) as infile:
-        data = parse_txt_file(infile, year)
-        for site in data:
-            data[site] = extract_site_data(data[site])
-            counts_table = counts_table.append(extract_counts(data[site], year),
-                                               ignore_index=True)
-            site_table = site_table.append(get_sites_table(data[site]),
-                                           ignore_index=True)
-            census_table = census_table.append(get_census_table(data[site], year),
-                                               ignore_index=True)
-
-# Provide information on fuzzy matching for error checking
-print("\nUnmatched species:\n")
-print(unmatched)
-print()
-print("\nFuzzy matched species:\n")
-print("RawSpecies, MatchedSpecies, Ratio")
-for raw_species in matched:
-    print('{}, {}, {}'.format(raw_species, matched[raw_species][0], matched[raw_species][1]))
-
-site_table_simp = site_table[['sitename', 'latitude', 'longitude']]
-unique_sites = site_table_simp.drop_duplicates().reset_index(drop=True)
-unique_sites['siteID'] = unique_sites.index + 1
-site_table = pd.merge(unique_sites, site_table, on = ['sitename', 'latitude', 'longitude'])
-siteID_links = site_table[['siteNumInCensus', 'siteID']]
-counts_table = pd.merge(counts_table, siteID_links, on = ["siteNumInCensus"])
-census_table = pd.merge(census_table, siteID_links, on = ["siteNumInCensus"])
-
-counts_table = counts_table[['siteID', 'year', 'species', 'count', 'status']]
-site_table = site_table[['siteID', 'sitename', 'latitude',
-                         'longitude', 'location', 'description']]
-census_table = census_table[['siteID', 'sitename', 'siteNumInCensus',
-                                       'year', 'established', 'ts_length', 'cov_hours',
-                                       'cov_visits', 'cov_times', 'cov_notes', 'area',
-                                       'richness', 'territories', 'terr_notes',
-                                       'weather']]
-counts_table.to_csv('output/bbc_counts.csv', index=False)
-census_table.to_csv('output/bbc_censuses.csv', index=False)
-site_table.to_csv('output/bbc_sites.csv', index=False)
+    Names marked for deletion map to None
+
+    """
+    names_data = pd.read_csv(sp_names_file)
+    corrections = dict()
+    for original, cleaned, notes in zip(names_data['original_name'],
+                                        names_data['cleaned_name'],
+                                        names_data['Notes']):
+        if notes == 'delete':
+            corrections[original] = None
+        else:
+            corrections[original] = original if pd.isnull(cleaned) else cleaned
+    return corrections
+
+def get_names_hash(valid_names):
+    """Get a short hash identifying a list of valid species names"""
+    return hashlib.sha256(repr(list(valid_names)).encode('utf-8')).hexdigest()[:16]
+
+def load_species_aliases(alias_file, name_corrections, valid_names):
+    """Load the table of raw species names with a known cleaned name
+
+    The table is seeded from the name corrections file and includes fuzzy
+    matches accepted in earlier runs against the same list of valid names.
+    Values are (cleaned name, score, source) tuples.
+
+    """
+    aliases = {original: (cleaned, 100, 'corrections')
+               for original, cleaned in name_corrections.items()}
+    if os.path.exists(alias_file):
+        alias_data = pd.read_csv(alias_file, keep_default_na=False)
+        alias_data = alias_data[(alias_data['source'] == 'fuzzy') &
+                                (alias_data['names_hash'] == get_names_hash(valid_names))]
+        for raw_name, cleaned_name, score in zip(alias_data['raw_name'],
+                                                 alias_data['cleaned_name'],
+                                                 alias_data['score']):
+            aliases.setdefault(raw_name, (cleaned_name, int(score), 'fuzzy'))
+    return aliases
+
+def save_species_aliases(alias_file, aliases, matched, valid_names):
+    """Add the accepted fuzzy matches to the alias table and save it"""
+    for raw_name in matched:
+        aliases.setdefault(raw_name, (matched[raw_name][0], matched[raw_name][1], 'fuzzy'))
+    names_hash = get_names_hash(valid_names)
+    alias_data = pd.DataFrame([(raw_name, cleaned_name, score, source,
+                                names_hash if source == 'fuzzy' else '')
+                               for raw_name, (cleaned_name, score, source) in aliases.items()],
+                              columns=['raw_name', 'cleaned_name', 'score',
+                                       'source', 'names_hash'])
+    os.makedirs(os.path.dirname(alias_file) or '.', exist_ok=True)
+    alias_data.to_csv(alias_file, index=False)
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.profile:
+        # profile every year in this process
+        instrumentation.start_profiling()
+        args.jobs = 1
+        args.no_checkpoints = True
+    run_start = time.perf_counter()
+    data_path = "./data/"
+    valid_sp_names = get_valid_sp_names("data/bbc_species_corrections.csv")
+    name_corrections = get_name_corrections("data/bbc_species_corrections.csv")
+    species_aliases = load_species_aliases(args.aliases, name_corrections, valid_sp_names)
+
+    counts_rows = new_table_buffer(counts_schema)
+    site_rows = new_table_buffer(sites_schema)
+    census_rows = new_table_buffer(census_schema)
+    years = list(range(1988, 1996)) + list(range(2003, 2010))
+
+    # Only reprocess the years whose text, replacements, species or code changed
+    year_results = dict()
+    checkpoint_keys = dict()
+    for year in years:
+        checkpoint_keys[year] = get_year_checkpoint_key(year, data_path, valid_sp_names,
+                                                         name_corrections)
+        if not args.no_checkpoints:
+            year_results[year] = load_year_checkpoint(args.checkpoint_dir, year,
+                                                      checkpoint_keys[year])
+    changed_years = [year for year in years if year_results.get(year) is None]
+    print("Reusing checkpoints for {} of {} years".format(len(years) - len(changed_years),
+                                                          len(years)))
+    if args.jobs > 1 and len(changed_years) > 1:
+        with Pool(min(args.jobs, len(changed_years)), initializer=set_valid_species,
+                  initargs=(valid_sp_names, species_aliases)) as pool:
+            changed_results = pool.starmap(process_year,
+                                           [(year, data_path) for year in changed_years])
+    else:
+        set_valid_species(valid_sp_names, species_aliases)
+        changed_results = [process_year(year, data_path) for year in changed_years]
+    for year, results in zip(changed_years, changed_results):
+        save_year_checkpoint(args.checkpoint_dir, year, checkpoint_keys[year], results)
+        year_results[year] = results
+
+    # Combine the reports from each processed year
+    instrumentation.reset_report()
+    for year in years:
+        if year in changed_years:
+            instrumentation.merge_report(year_results[year]['report'])
+            count('checkpoint_misses', year=year)
+        else:
+            count('checkpoint_hits', year=year)
+    year_results = [year_results[year] for year in years]
+
+    # Merge in year order, keeping the first time each species was seen
+    all_unmatched = []
+    all_matched = {}
+    all_replacement_hits = Counter()
+    failed_rows = []
+    unmatched_seen = set()
+    for results in year_results:
+        append_rows(counts_rows, results['counts'])
+        append_rows(site_rows, results['sites'])
+        append_rows(census_rows, results['censuses'])
+        for raw_species, matched_species in results['unmatched']:
+            if raw_species not in unmatched_seen:
+                unmatched_seen.add(raw_species)
+                all_unmatched.append((raw_species, matched_species))
+        for raw_species in results['matched']:
+            all_matched.setdefault(raw_species, results['matched'][raw_species])
+        all_replacement_hits.update(results['replacement_hits'])
+        failed_rows.extend(results['failed_rows'])
+    unmatched, matched, replacement_hits = all_unmatched, all_matched, all_replacement_hits
+    save_species_aliases(args.aliases, species_aliases, matched, valid_sp_names)
+
+    counts_table = build_table(counts_rows, counts_schema)
+    site_table = build_table(site_rows, sites_schema)
+    census_table = build_table(census_rows, census_schema)
+
+    link_start = time.perf_counter()
+    site_years = site_table[['siteNumInCensus', 'sitename', 'latitude', 'longitude']]
+    site_ids, site_links = link_sites(site_years.itertuples(index=False, name=None),
+                                      load_site_ids(args.site_ids))
+    for link in site_links:
+        count('site_links', match=link['match'])
+    count('sites_linked', len(set(site_ids.values())))
+    site_table.insert(0, 'siteID', site_table['siteNumInCensus'].map(site_ids))
+    site_table = site_table.sort_values('siteID', kind='stable')
+    siteID_links = site_table[['siteNumInCensus', 'siteID']]
+    counts_table = pd.merge(counts_table, siteID_links, on = ["siteNumInCensus"])
+    census_table = pd.merge(census_table, siteID_links, on = ["siteNumInCensus"])
+
+    counts_table = counts_table[['siteID', 'year', 'species', 'count', 'status']]
+    site_table = site_table[['siteID', 'sitename', 'latitude',
+                             'longitude', 'location', 'description']]
+    census_table = census_table[['siteID', 'sitename', 'siteNumInCensus',
+                                           'year', 'established', 'ts_length', 'cov_hours',
+                                           'cov_visits', 'cov_times', 'cov_notes', 'area',
+                                           'richness', 'territories', 'terr_notes',
+                                           'weather']]
+    instrumentation.add_timing('link_sites', time.perf_counter() - link_start)
+    write_start = time.perf_counter()
+    counts_table.to_csv('output/bbc_counts.csv', index=False)
+    census_table.to_csv('output/bbc_censuses.csv', index=False)
+    site_table.to_csv('output/bbc_sites.csv', index=False)
+    if args.columnar:
+        write_columnar_tables({'bbc_counts': counts_table,
+                               'bbc_censuses': census_table,
+                               'bbc_sites': site_table},
+                              'output/columnar/', args.columnar)
+    instrumentation.add_timing('write_output', time.perf_counter() - write_start)
+    instrumentation.add_timing('run', time.perf_counter() - run_start)
+
+    # Provide information on fuzzy matching for error checking in the report
+    instrumentation.write_report(
+        args.report,
+        unmatched_species=[{'raw_species': raw_species, 'best_match': best_match[0],
+                            'ratio': best_match[1]}
+                           for raw_species, best_match in unmatched],
+        fuzzy_matched_species=[{'raw_species': raw_species, 'matched_species': matched[raw_species][0],
+                                'ratio': matched[raw_species][1]}
+                               for raw_species in matched],
+        replacement_hits=dict(replacement_hits.most_common()),
+        failed_rows=failed_rows,
+        site_links=site_links)
+    print("\n{} unmatched and {} fuzzy matched species, {} replacements made".format(
+        len(unmatched), len(matched), sum(replacement_hits.values())))
+    if failed_rows:
+        print("{} fields couldn't be parsed and were left empty".format(len(failed_rows)))
+    print("Timings, counters and matching diagnostics written to {}".format(args.report))
+    if args.profile:
+        instrumentation.write_profile(args.profile)
@@ -0,0 +1,184 @@
+"""Benchmark each stage of bbc-text-mining.py on a synthetic corpus
+
+Run from the root directory using, e.g.:
+
+python benchmarks/bench_pipeline.py --sites 1000 --save baseline.json
+python benchmarks/bench_pipeline.py --sites 1000 --baseline baseline.json
+
+Reports the throughput and peak traced memory of each stage. When a baseline
+from an earlier run is given, stages whose throughput dropped or whose peak
+memory grew by more than --tolerance are flagged and the exit code is 1.
+
+"""
+
+import argparse
+import contextlib
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from make_synthetic_corpus import make_corpus
+from utils import load_bbc, root_dir
+
+years = list(range(1988, 1996)) + list(range(2003, 2010))
+
+def setup_species(bbc):
+    """Set the valid species names and corrections used by get_cleaned_species"""
+    sp_names_file = os.path.join(root_dir, "data", "bbc_species_corrections.csv")
+    valid_names = bbc.get_valid_sp_names(sp_names_file)
+    name_corrections = bbc.get_name_corrections(sp_names_file)
+    bbc.set_valid_species(valid_names,
+                          bbc.load_species_aliases('', name_corrections, valid_names))
+
+def get_inputs(bbc, corpus_path):
+    """Collect the inputs each stage works on from one pass over the corpus"""
+    inputs = {'files': [], 'blocks': [], 'sites': [], 'species': []}
+    parse_block = bbc.parse_block
+    def recording_parse_block(*args):
+        inputs['blocks'].append(args)
+        return parse_block(*args)
+    bbc.parse_block = recording_parse_block
+    for year in years:
+        path = os.path.join(corpus_path, "bbc_combined_{}.txt".format(year))
+        inputs['files'].append((year, path))
+        with open(path) as infile:
+            for site_num, site_data in bbc.iter_sites(infile, year):
+                inputs['sites'].append((year, site_data))
+    bbc.parse_block = parse_block
+
+    get_cleaned_species = bbc.get_cleaned_species
+    def recording_get_cleaned_species(species):
+        inputs['species'].append(species)
+        return get_cleaned_species(species)
+    bbc.get_cleaned_species = recording_get_cleaned_species
+    for year, site_data in inputs['sites']:
+        bbc.extract_counts(bbc.extract_site_data(copy.deepcopy(site_data), year), year)
+    bbc.get_cleaned_species = get_cleaned_species
+    inputs['species'] = list(dict.fromkeys(inputs['species']))
+    return inputs
+
+def get_stages(bbc, inputs, corpus_path):
+    """Get a function for each stage that returns the number of items processed"""
+    def iter_sites():
+        n_sites = 0
+        for year, path in inputs['files']:
+            with open(path) as infile:
+                n_sites += sum(1 for _ in bbc.iter_sites(infile, year))
+        return n_sites
+    def parse_block():
+        for args in inputs['blocks']:
+            bbc.parse_block(*args)
+        return len(inputs['blocks'])
+    def extract_site_data():
+        for year, site_data in inputs['sites']:
+            bbc.extract_site_data(dict(site_data), year)
+        return len(inputs['sites'])
+    extracted_sites = [(year, bbc.extract_site_data(copy.deepcopy(site_data), year))
+                       for year, site_data in inputs['sites']]
+    def extract_counts():
+        bbc.get_cleaned_species.cache_clear()
+        for year, site_data in extracted_sites:
+            bbc.extract_counts(site_data, year)
+        return len(extracted_sites)
+    def get_cleaned_species():
+        bbc.get_cleaned_species.cache_clear()
+        for species in inputs['species']:
+            bbc.get_cleaned_species(species)
+        return len(inputs['species'])
+    def end_to_end():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for year in years:
+                bbc.process_year(year, corpus_path)
+        return len(inputs['sites'])
+    return {'iter_sites': iter_sites,
+            'parse_block': parse_block,
+            'extract_site_data': extract_site_data,
+            'extract_counts': extract_counts,
+            'get_cleaned_species': get_cleaned_species,
+            'end_to_end': end_to_end}
+
+def run_stage(stage, repeat):
+    """Time a stage (best of repeat runs) and measure its peak traced memory"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n_items = stage()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    seconds = min(timings)
+    return {'items': n_items, 'seconds': seconds,
+            'items_per_second': n_items / seconds if seconds else float('inf'),
+            'peak_mb': peak / 1024 / 1024}
+
+def find_regressions(results, baseline, tolerance):
+    """List stages that got slower or used more memory than the baseline"""
+    regressions = []
+    for stage in results:
+        if stage not in baseline:
+            continue
+        old, new = baseline[stage], results[stage]
+        if new['items_per_second'] < old['items_per_second'] * (1 - tolerance):
+            regressions.append("{}: {:.1f} -> {:.1f} items/s".format(
+                stage, old['items_per_second'], new['items_per_second']))
+        # ignore small absolute changes in stages that use very little memory
+        if (new['peak_mb'] > old['peak_mb'] * (1 + tolerance) and
+                new['peak_mb'] - old['peak_mb'] > 1):
+            regressions.append("{}: peak memory {:.1f} -> {:.1f} MB".format(
+                stage, old['peak_mb'], new['peak_mb']))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the BBC text mining stages")
+    parser.add_argument('--sites', type=int, default=1000,
+                        help="number of synthetic sites to generate (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus',
+                        help="use the bbc_combined_<year>.txt files in this directory "
+                             "instead of generating them")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of timed runs of each stage (default: %(default)s)")
+    parser.add_argument('--save', help="save the results as JSON to this file")
+    parser.add_argument('--baseline', help="compare against results saved with --save")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed fractional slowdown or memory growth "
+                             "before flagging a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    bbc = load_bbc()
+    setup_species(bbc)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_path = args.corpus
+        if corpus_path is None:
+            corpus_path = tmp_dir
+            make_corpus(corpus_path, years, args.sites, args.seed)
+        inputs = get_inputs(bbc, corpus_path)
+        stages = get_stages(bbc, inputs, corpus_path)
+        results = dict()
+        for name, stage in stages.items():
+            results[name] = run_stage(stage, args.repeat)
+
+    print("{:<20} {:>8} {:>10} {:>12} {:>10}".format("stage", "items", "seconds",
+                                                     "items/s", "peak MB"))
+    for name, result in results.items():
+        print("{:<20} {:>8} {:>10.3f} {:>12.1f} {:>10.1f}".format(
+            name, result['items'], result['seconds'], result['items_per_second'],
+            result['peak_mb']))
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    if args.baseline:
+        with open(args.baseline) as infile:
+            regressions = find_regressions(results, json.load(infile), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("\nNo regressions against {}".format(args.baseline))
@@ -0,0 +1,54 @@
+"""Benchmark the indexed species matcher against fuzzywuzzy's linear scan
+
+Run from the root directory using:
+
+python benchmarks/bench_species_matcher.py
+
+Raw names are taken from the species column of output/bbc_counts.csv and the
+OCR'd original names in data/bbc_species_corrections.csv. Each unique name is
+matched once with process.extractOne (as get_cleaned_species used to) and once
+with match_species, and the results are checked to be identical.
+
+"""
+
+import os
+import time
+
+import pandas as pd
+from fuzzywuzzy import fuzz, process
+
+from utils import load_bbc, root_dir
+
+def time_matcher(matcher, raw_names):
+    """Match every raw name and return the results and elapsed seconds"""
+    start = time.perf_counter()
+    results = [matcher(raw_name) for raw_name in raw_names]
+    return results, time.perf_counter() - start
+
+if __name__ == '__main__':
+    root = root_dir
+    bbc = load_bbc()
+    valid_sp_names = bbc.get_valid_sp_names(os.path.join(root, "data", "bbc_species_corrections.csv"))
+    species_index = bbc.build_species_index(valid_sp_names)
+
+    counts = pd.read_csv(os.path.join(root, "output", "bbc_counts.csv"))
+    corrections = pd.read_csv(os.path.join(root, "data", "bbc_species_corrections.csv"))
+    raw_names = list(counts['species'].dropna()) + list(corrections['original_name'].dropna())
+    unique_names = list(dict.fromkeys(raw_names))
+
+    linear = lambda name: process.extractOne(name, valid_sp_names, processor=str,
+                                             scorer=fuzz.ratio)
+    indexed = lambda name: bbc.match_species(name, species_index)
+    linear_results, linear_time = time_matcher(linear, unique_names)
+    indexed_results, indexed_time = time_matcher(indexed, unique_names)
+
+    mismatches = [(name, old, new) for name, old, new
+                  in zip(unique_names, linear_results, indexed_results)
+                  if tuple(old) != tuple(new)]
+    print("{} raw names, {} unique, {} valid names".format(len(raw_names), len(unique_names),
+                                                         len(valid_sp_names)))
+    print("extractOne:    {:.3f} s".format(linear_time))
+    print("match_species: {:.3f} s ({:.1f}x faster)".format(indexed_time, linear_time / indexed_time))
+    print("mismatched results: {}".format(len(mismatches)))
+    for name, old, new in mismatches:
+        print("  {!r}: {} != {}".format(name, old, new))
@@ -0,0 +1,151 @@
+"""Generate synthetic BBC text files for benchmarking
+
+The published pdfs can't be redistributed, so this writes made up
+bbc_combined_<year>.txt files in the same layout as the OCR'd and pdftotext'd
+years. Years up to 1988 use the older Coverage/Continuity formats. Species are
+drawn from BBC_pdfs/valid_species.csv and OCR noise is injected by swapping
+correct text for the mistakes listed in the block replacement table.
+
+Run from the root directory using, e.g.:
+
+python benchmarks/make_synthetic_corpus.py --sites 500 --output synthetic/
+
+"""
+
+import argparse
+import os
+import random
+import textwrap
+
+from utils import load_bbc, root_dir
+
+states = ['California', 'Connecticut', 'Maryland', 'New York', 'Ohio',
+          'Pennsylvania', 'Virginia', 'West Virginia', 'Wisconsin']
+habitats = ['OAK-HICKORY FOREST', 'LOWLAND HARDWOOD RIPARIAN', 'OLD FIELD',
+            'MIXED UPLAND HABITATS', 'SPRUCE-FIR FOREST', 'SALT MARSH',
+            'MATURE TULIP-TREE FOREST', 'SUBURBAN PARK', 'PINE PLANTATION']
+words = ['canopy', 'trees', 'shrubs', 'dominant', 'ground', 'cover', 'stream',
+         'slope', 'elevation', 'plot', 'Red Maple', 'Northern Red Oak',
+         'Black Birch', 'Witch Hazel', 'blueberry', 'swamp', 'water', 'road']
+
+def get_species_names(species_file):
+    """Read the list of species names used to fill in the censuses"""
+    with open(species_file) as infile:
+        return [line.strip() for line in infile if line.strip()]
+
+def get_noise_rules(block_replacements):
+    """Get (correct text, OCR mistake) pairs that can be injected as noise
+
+    Only rules that fix a single recognisable word or name are used, so that
+    the noise is removed again by parse_block.
+
+    """
+    rules = []
+    for mistake, correct in block_replacements.items():
+        if len(correct) >= 5 and correct.replace('-', '').replace(' ', '').isalpha():
+            rules.append((correct, mistake))
+    return rules
+
+def make_sentence(rng, n_words):
+    """Make a sentence of filler text"""
+    return ' '.join(rng.choice(words) for _ in range(n_words)).capitalize() + '.'
+
+def make_site(rng, site_num, year, species_names):
+    """Make the text for one site"""
+    modern = year > 1988
+    n_species = rng.randint(5, 40)
+    breeders = rng.sample(species_names, n_species)
+    visitors = rng.sample(species_names, rng.randint(0, 8))
+    counts = [rng.choice([rng.randint(1, 20), rng.randint(1, 40) / 2]) for _ in breeders]
+    census = '; '.join('{}, {}'.format(species, float(count)) +
+                       (' ({})'.format(rng.randint(1, 99)) if rng.random() < 0.2 else '')
+                       for species, count in zip(breeders, counts))
+    hours = round(rng.uniform(5, 60), 1)
+    visits = rng.randint(3, 25)
+    established = rng.randint(1937, year)
+    if modern:
+        coverage = "{} h; {} Visits; {} April to {} July.".format(hours, visits,
+                                                                rng.randint(1, 30),
+                                                                rng.randint(1, 30))
+        continuity = "Established {}; {} yr.".format(established, rng.randint(1, 20))
+    else:
+        coverage = "{} Visits; {} study-hours; {} April to {} July.".format(visits, int(hours),
+                                                                          rng.randint(1, 30),
+                                                                          rng.randint(1, 30))
+        continuity = "Established {} {} yr.".format(established, rng.randint(1, 20))
+    fields = [
+        ('Location', "{}; {} Co.; {}°{}'N, {}°{}'W.".format(
+            rng.choice(states), rng.choice(words).title(), rng.randint(25, 48),
+            rng.randint(0, 59), rng.randint(70, 124), rng.randint(0, 59))),
+        ('Continuity', continuity),
+        ('Size', "{} ha.".format(round(rng.uniform(2, 60), 1))),
+        ('Description of Plot', ' '.join(make_sentence(rng, rng.randint(8, 20))
+                                         for _ in range(rng.randint(2, 12)))),
+        ('Weather', make_sentence(rng, rng.randint(5, 15))),
+        ('Coverage', coverage),
+        ('Census', census + '.'),
+        ('Total', "{} species; {} territories ({}/km2).".format(
+            n_species, sum(counts), rng.randint(50, 1500))),
+    ]
+    if visitors:
+        fields.append(('Visitors', ', '.join(visitors) + '.'))
+    fields.append(('Remarks', make_sentence(rng, rng.randint(5, 30))))
+    fields.append(('Observers', make_sentence(rng, rng.randint(2, 6))))
+    lines = ["{}. {}".format(site_num, rng.choice(habitats))]
+    for field, value in fields:
+        lines.extend(textwrap.wrap("{}: {}".format(field, value), width=75,
+                                   break_on_hyphens=False))
+    return '\n'.join(lines) + '\n\n'
+
+def add_noise(rng, text, noise_rules, noise_rate):
+    """Replace some correct text with OCR mistakes from the replacement table"""
+    for correct, mistake in noise_rules:
+        if correct in text and rng.random() < noise_rate:
+            text = text.replace(correct, mistake, 1)
+    return text
+
+def make_year(rng, year, n_sites, species_names, noise_rules, noise_rate=0.3):
+    """Make the combined text for one year"""
+    sites = []
+    for site_num in range(1, n_sites + 1):
+        # site numbers are one or two digits in the published text
+        site = make_site(rng, (site_num - 1) % 99 + 1, year, species_names)
+        sites.append(add_noise(rng, site, noise_rules, noise_rate))
+    return ''.join(sites)
+
+def make_corpus(output_path, years, n_sites, seed=0, noise_rate=0.3):
+    """Write bbc_combined_<year>.txt files with n_sites sites in total
+
+    Returns the paths of the files written
+
+    """
+    bbc = load_bbc()
+    rng = random.Random(seed)
+    species_names = get_species_names(os.path.join(root_dir, "BBC_pdfs", "valid_species.csv"))
+    noise_rules = get_noise_rules(bbc.block_replacements)
+    os.makedirs(output_path, exist_ok=True)
+    paths = []
+    for position, year in enumerate(years):
+        year_sites = n_sites // len(years) + (position < n_sites % len(years))
+        path = os.path.join(output_path, "bbc_combined_{}.txt".format(year))
+        with open(path, 'w') as outfile:
+            outfile.write(make_year(rng, year, year_sites, species_names,
+                                    noise_rules, noise_rate))
+        paths.append(path)
+    return paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic BBC text files")
+    parser.add_argument('--sites', type=int, default=1000,
+                        help="total number of sites (default: %(default)s)")
+    parser.add_argument('--years', type=int, nargs='+',
+                        default=list(range(1988, 1996)) + list(range(2003, 2010)),
+                        help="years to generate (default: the years used by bbc-text-mining.py)")
+    parser.add_argument('--noise', type=float, default=0.3,
+                        help="chance of injecting each OCR mistake into a site (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default="./synthetic/",
+                        help="directory to write the text files to (default: %(default)s)")
+    args = parser.parse_args()
+    for path in make_corpus(args.output, args.years, args.sites, args.seed, args.noise):
+        print(path)
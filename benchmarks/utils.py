@@ -0,0 +1,20 @@
+"""Shared helpers for the benchmark scripts"""
+
+import importlib.util
+import os
+import sys
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_script(path, name):
+    """Import one of the repository's scripts as a module"""
+    if root_dir not in sys.path:
+        sys.path.insert(0, root_dir) # for the modules the scripts import
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_bbc():
+    """Import bbc-text-mining.py"""
+    return load_script(os.path.join(root_dir, "bbc-text-mining.py"), "bbc_text_mining")
@@ -0,0 +1,230 @@
+"""Query the census tables written by bbc-text-mining.py in memory
+
+load_store reads output/bbc_counts.csv, bbc_censuses.csv and bbc_sites.csv
+into integer coded numpy columns with indexes of the rows for each species,
+siteID and year, a (siteID, year) index of the censuses and a grid of site
+locations, so that lookups only touch the rows they return. e.g.:
+
+store = load_store('./output/')
+near = find_sites_near(store, 42.4, 76.5, 200)
+get_counts(store, species='Wood Thrush', years=range(1988, 1996), site_ids=near)
+get_census_series(store, 12, 'richness')
+
+Run it as a script to export the tables to an indexed SQLite database:
+
+python census_store.py --sqlite output/bbc.sqlite
+
+"""
+
+import argparse
+import math
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+# Size in degrees of the cells in the grid of site locations
+grid_size = 1.0
+earth_radius_km = 6371.0
+
+def build_index(codes):
+    """Map each value in an integer column to the sorted positions of its rows"""
+    order = np.argsort(codes, kind='stable')
+    values, starts = np.unique(codes[order], return_index=True)
+    return dict(zip(values.tolist(), np.split(order, starts[1:])))
+
+def get_grid_cell(latitude, longitude):
+    """Get the grid cell a location falls in"""
+    return (math.floor(latitude / grid_size), math.floor(longitude / grid_size))
+
+def build_store(counts, censuses, sites):
+    """Build the query store from the counts, censuses and sites tables"""
+    species_codes, species_names = pd.factorize(counts['species'], sort=True)
+    status_codes, statuses = pd.factorize(counts['status'], sort=True)
+    store = {'species_names': list(species_names),
+             'species_codes': {name: code for code, name in enumerate(species_names)},
+             'statuses': list(statuses),
+             'counts': {'siteID': counts['siteID'].to_numpy(dtype='int64'),
+                        'year': counts['year'].to_numpy(dtype='int64'),
+                        'species': species_codes.astype('int32'),
+                        'count': counts['count'].to_numpy(dtype=object),
+                        'status': status_codes.astype('int8')},
+             'censuses': censuses.reset_index(drop=True)}
+    store['species_index'] = build_index(store['counts']['species'])
+    store['site_index'] = build_index(store['counts']['siteID'])
+    store['year_index'] = build_index(store['counts']['year'])
+    census_keys = zip(censuses['siteID'].astype('int64').tolist(),
+                      censuses['year'].astype('int64').tolist())
+    store['census_index'] = {key: position for position, key in enumerate(census_keys)}
+    store['census_site_index'] = build_index(censuses['siteID'].to_numpy(dtype='int64'))
+    # The location of each site is taken from its first site-year
+    store['sites'] = dict()
+    store['grid'] = dict()
+    for site_id, sitename, latitude, longitude in sites[['siteID', 'sitename', 'latitude',
+                                                         'longitude']].itertuples(index=False):
+        site_id = int(site_id)
+        if site_id in store['sites']:
+            continue
+        store['sites'][site_id] = {'sitename': sitename, 'latitude': latitude,
+                                   'longitude': longitude}
+        if pd.notna(latitude) and pd.notna(longitude):
+            store['grid'].setdefault(get_grid_cell(latitude, longitude), []).append(site_id)
+    return store
+
+def load_store(output_dir='./output/'):
+    """Load the tables written by bbc-text-mining.py into a query store"""
+    counts = pd.read_csv(os.path.join(output_dir, 'bbc_counts.csv'))
+    censuses = pd.read_csv(os.path.join(output_dir, 'bbc_censuses.csv'))
+    sites = pd.read_csv(os.path.join(output_dir, 'bbc_sites.csv'))
+    return build_store(counts, censuses, sites)
+
+def get_distance_km(latitude1, longitude1, latitude2, longitude2):
+    """Get the great circle distance between two locations"""
+    latitude1, longitude1, latitude2, longitude2 = map(
+        math.radians, [latitude1, longitude1, latitude2, longitude2])
+    a = (math.sin((latitude2 - latitude1) / 2) ** 2 + math.cos(latitude1) *
+         math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * earth_radius_km * math.asin(min(1.0, math.sqrt(a)))
+
+def find_sites_near(store, latitude, longitude, radius_km):
+    """Get the siteIDs within radius_km of a location, nearest first
+
+    Longitudes are in degrees west, as in the sites table
+
+    """
+    latitude_span = math.degrees(radius_km / earth_radius_km)
+    # cells get narrower towards the poles, so use the widest latitude covered
+    widest = min(89.0, abs(latitude) + latitude_span)
+    longitude_span = latitude_span / math.cos(math.radians(widest))
+    low = get_grid_cell(latitude - latitude_span, longitude - longitude_span)
+    high = get_grid_cell(latitude + latitude_span, longitude + longitude_span)
+    found = []
+    for row in range(low[0], high[0] + 1):
+        for column in range(low[1], high[1] + 1):
+            for site_id in store['grid'].get((row, column), []):
+                site = store['sites'][site_id]
+                distance = get_distance_km(latitude, longitude, site['latitude'],
+                                           site['longitude'])
+                if distance <= radius_km:
+                    found.append((distance, site_id))
+    return [site_id for distance, site_id in sorted(found)]
+
+def get_rows(index, keys):
+    """Get the row positions for any of the keys in an index"""
+    positions = [index[key] for key in keys if key in index]
+    if not positions:
+        return np.empty(0, dtype='int64')
+    return np.sort(np.concatenate(positions))
+
+def get_count_rows(store, species=None, years=None, site_ids=None):
+    """Get the positions of the counts rows matching all of the filters given
+
+    species is a name or list of names, years and site_ids are lists of values
+
+    """
+    filters = []
+    if species is not None:
+        names = [species] if isinstance(species, str) else species
+        codes = [store['species_codes'][name] for name in names
+                 if name in store['species_codes']]
+        filters.append(get_rows(store['species_index'], codes))
+    if site_ids is not None:
+        filters.append(get_rows(store['site_index'], site_ids))
+    if years is not None:
+        filters.append(get_rows(store['year_index'], years))
+    if not filters:
+        return np.arange(len(store['counts']['year']))
+    # intersect starting with the most selective filter
+    filters.sort(key=len)
+    rows = filters[0]
+    for other in filters[1:]:
+        rows = np.intersect1d(rows, other, assume_unique=True)
+    return rows
+
+def get_counts(store, species=None, years=None, site_ids=None):
+    """Get the counts matching all of the filters given as a list of dicts"""
+    counts = store['counts']
+    rows = get_count_rows(store, species, years, site_ids)
+    return [{'siteID': site_id, 'year': year, 'species': store['species_names'][species_code],
+             'count': count, 'status': store['statuses'][status]}
+            for site_id, year, species_code, count, status in zip(
+                counts['siteID'][rows].tolist(), counts['year'][rows].tolist(),
+                counts['species'][rows].tolist(), counts['count'][rows].tolist(),
+                counts['status'][rows].tolist())]
+
+def get_census(store, site_id, year):
+    """Get the census of a site in a year as a dict, or None if there wasn't one"""
+    position = store['census_index'].get((site_id, year))
+    if position is None:
+        return None
+    return store['censuses'].iloc[position].to_dict()
+
+def get_census_series(store, site_id, column):
+    """Get (year, value) for a census column of a site across the years"""
+    censuses = store['censuses']
+    positions = store['census_site_index'].get(site_id, [])
+    values = censuses[column].to_numpy()
+    years = censuses['year'].to_numpy()
+    return sorted((int(years[position]), values[position]) for position in positions)
+
+def join_censuses(store, counts, columns):
+    """Add census columns to counts rows from get_counts, joined on siteID and year"""
+    censuses = store['censuses']
+    values = {column: censuses[column].to_numpy() for column in columns}
+    for row in counts:
+        position = store['census_index'].get((row['siteID'], row['year']))
+        for column in columns:
+            row[column] = None if position is None else values[column][position]
+    return counts
+
+def export_sqlite(store, path):
+    """Write the store to an SQLite database with the same indexes
+
+    Species are stored once in a species table and referenced by code from the
+    counts table. The counts_named view has the species names filled in.
+
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    counts = store['counts']
+    with sqlite3.connect(path) as connection:
+        pd.DataFrame({'species_id': range(len(store['species_names'])),
+                      'species': store['species_names']}).to_sql(
+                          'species', connection, index=False)
+        pd.DataFrame({'siteID': counts['siteID'], 'year': counts['year'],
+                      'species_id': counts['species'], 'count': counts['count'],
+                      'status': [store['statuses'][status] for status in counts['status']]}
+                     ).to_sql('counts', connection, index=False)
+        store['censuses'].to_sql('censuses', connection, index=False)
+        pd.DataFrame([dict(site, siteID=site_id) for site_id, site in store['sites'].items()]
+                     ).to_sql('sites', connection, index=False)
+        connection.executescript("""
+            CREATE UNIQUE INDEX species_by_name ON species (species);
+            CREATE INDEX counts_by_species ON counts (species_id, year);
+            CREATE INDEX counts_by_site ON counts (siteID, year);
+            CREATE INDEX counts_by_year ON counts (year);
+            CREATE INDEX censuses_by_site ON censuses (siteID, year);
+            CREATE INDEX sites_by_location ON sites (latitude, longitude);
+            CREATE VIEW counts_named AS
+                SELECT counts.siteID, counts.year, species.species, counts.count, counts.status
+                FROM counts JOIN species USING (species_id);
+        """)
+
+def get_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Load the BBC census tables into a query store")
+    parser.add_argument('--output-dir', default="./output/",
+                        help="directory holding the tables from bbc-text-mining.py "
+                             "(default: %(default)s)")
+    parser.add_argument('--sqlite', help="export the tables to this SQLite database")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    store = load_store(args.output_dir)
+    print("Loaded {} counts of {} species from {} sites".format(
+        len(store['counts']['year']), len(store['species_names']), len(store['sites'])))
+    if args.sqlite:
+        export_sqlite(store, args.sqlite)
+        print("Exported to {}".format(args.sqlite))
@@ -0,0 +1,129 @@
+"""Write and read the combined text file for each year with a page and site index
+
+combine_pages streams the page text files for a year into
+bbc_combined_<year>.txt and writes a sidecar bbc_combined_<year>.index.json
+with the byte offset of each page and of each site header line. The combined
+file can then be memory-mapped with map_combined_file and single pages or
+sites read with read_page and read_site without reading the rest of the file.
+
+"""
+
+import json
+import mmap
+import os
+import re
+from contextlib import contextmanager
+
+site_header_regex = re.compile(r"^([0-9]{1,2})\. ([A-Z —-]{2,})")
+page_file_regex = re.compile(r"-([0-9]+)\.txt$")
+
+def get_index_path(combined_path):
+    """Get the path of the index for a combined file"""
+    return os.path.splitext(combined_path)[0] + ".index.json"
+
+def combine_pages(page_paths, combined_path):
+    """Stream page text files into a combined file and index it
+
+    Pages are copied a line at a time and site headers are found in the lines
+    of the combined file, as bbc-text-mining.py reads them, so a header that
+    follows a page without a trailing newline isn't indexed there either. Each
+    site is indexed under the page its header line ends on.
+
+    Returns the index
+
+    """
+    pages = []
+    sites = []
+    offset = 0
+    line_start = 0
+    partial_line = b''
+    def index_line(line, page):
+        site_header = site_header_regex.search(line.decode('utf-8', 'replace'))
+        if site_header:
+            sites.append({'site': int(site_header.group(1)), 'name': site_header.group(2),
+                          'offset': line_start, 'page': page})
+    with open(combined_path, 'wb') as outfile:
+        for page_path in page_paths:
+            page_number = page_file_regex.search(page_path)
+            page = int(page_number.group(1)) if page_number else len(pages)
+            pages.append({'page': page, 'file': os.path.basename(page_path),
+                          'offset': offset})
+            with open(page_path, 'rb') as infile:
+                for line in infile:
+                    outfile.write(line)
+                    if line.endswith(b'\n'):
+                        index_line(partial_line + line, page)
+                        partial_line = b''
+                        line_start = offset + len(line)
+                    else:
+                        partial_line += line
+                    offset += len(line)
+            pages[-1]['length'] = offset - pages[-1]['offset']
+        if partial_line:
+            index_line(partial_line, pages[-1]['page'])
+    index = {'size': offset, 'pages': pages, 'sites': sites}
+    with open(get_index_path(combined_path), 'w') as outfile:
+        json.dump(index, outfile, indent=1)
+    return index
+
+def load_index(combined_path):
+    """Load the index for a combined file
+
+    Returns None if there isn't one or if the combined file has changed size
+    since it was indexed, e.g. after being edited by hand
+
+    """
+    index_path = get_index_path(combined_path)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as infile:
+        index = json.load(infile)
+    if index['size'] != os.path.getsize(combined_path):
+        return None
+    return index
+
+@contextmanager
+def map_combined_file(combined_path):
+    """Memory-map a combined file, yielding the map and the file's index"""
+    index = load_index(combined_path)
+    if index is None:
+        raise ValueError("{} has no up to date index, re-run "
+                         "convert-pdfs-to-txt.py to rebuild it".format(combined_path))
+    with open(combined_path, 'rb') as infile:
+        if index['size'] == 0:
+            # empty files can't be mapped
+            yield b'', index
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped, index
+
+def read_page(mapped, index, page):
+    """Read the text of a single (zero indexed) pdf page from a mapped file"""
+    for page_info in index['pages']:
+        if page_info['page'] == page:
+            start = page_info['offset']
+            return mapped[start:start + page_info['length']].decode('utf-8', 'replace')
+    raise KeyError("page {} isn't in the combined file".format(page))
+
+def read_site(mapped, index, site):
+    """Read the text of a site, from its header line to the next site's
+
+    If a site number appears more than once the first is read
+
+    """
+    for position, site_info in enumerate(index['sites']):
+        if site_info['site'] == site:
+            start = site_info['offset']
+            if position + 1 < len(index['sites']):
+                end = index['sites'][position + 1]['offset']
+            else:
+                end = index['size']
+            return mapped[start:end].decode('utf-8', 'replace')
+    raise KeyError("site {} isn't in the combined file".format(site))
+
+def get_site_pages(index):
+    """Get the pdf page each site header is on, {site number: page}"""
+    site_pages = dict()
+    for site_info in index['sites']:
+        site_pages.setdefault(site_info['site'], site_info['page'])
+    return site_pages
@@ -1,63 +1,771 @@
+import argparse
+import hashlib
 import os
 import re
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from glob import glob
+from xml.etree import ElementTree
 
-def convert_pdf_to_images(filename, output_path, ocr_margins):
-    """Convert a pdf to images"""
+import instrumentation
+from combined_files import combine_pages
+from instrumentation import count, timed
+
+def get_page_count(pdf_path):
+    """Get the number of pages in a pdf using pdfinfo"""
+    info = subprocess.check_output(["pdfinfo", pdf_path]).decode('utf-8', 'replace')
+    pages = re.search(r'^Pages:\s+([0-9]+)', info, re.MULTILINE)
+    return int(pages.group(1))
+
+def get_pdf_pages(pdf_path, info):
+    """Get the (zero indexed) pages of a pdf that hold the paragraph data
+
+    Uses 'start_page' and the optional 'end_page' and 'excluded_pages' from a
+    pdf_info entry, which are numbered from 1 as in a pdf viewer.
+
+    """
+    end_page = info.get('end_page', get_page_count(pdf_path))
+    excluded_pages = info.get('excluded_pages', [])
+    return [page - 1 for page in range(info['start_page'], end_page + 1)
+            if page not in excluded_pages]
+
+# ocr_margins are in pixels of a page rendered at this density
+margins_density = 375
+
+def parse_geometry(ocr_margins):
+    """Parse an ImageMagick style crop geometry, e.g. 0x0+0+330, into (x, y, width, height)"""
+    match = re.fullmatch(r'([0-9]+)x([0-9]+)\+([0-9]+)\+([0-9]+)', ocr_margins)
+    if match is None:
+        raise ValueError("Bad crop geometry: {}".format(ocr_margins))
+    width, height, x, y = [int(value) for value in match.groups()]
+    return x, y, width, height
+
+def get_crop_box(ocr_margins, density=margins_density):
+    """Turn an OCR crop geometry into pdftoppm options
+
+    The geometry is scaled from margins_density to the density the page is
+    rendered at, so the same area is cropped at every density. A width or
+    height of 0 keeps the rest of the page, as with -crop
+
+    """
+    x, y, width, height = [str(round(value * density / margins_density))
+                           for value in parse_geometry(ocr_margins)]
+    return ["-x", x, "-y", y, "-W", width, "-H", height]
+
+def get_rasterize_command(filename, page, ocr_margins, density=375):
+    """Get the pdftoppm command that renders the cropped area of a single page"""
+    return (["pdftoppm", "-png", "-singlefile", "-r", str(density),
+             "-f", str(page + 1), "-l", str(page + 1)] +
+            get_crop_box(ocr_margins, density) + [filename])
+
+def convert_pdf_page_to_image(filename, page, output_path, ocr_margins, density=375):
+    """Convert a single page of a pdf to an image
+
+    Pages are zero indexed and the image is named after the page, e.g.
+    BBC1988-0.png. Only the area inside the crop is rendered.
+
+    """
     filename_w_path = os.path.splitext(filename)[0]
     filename_wo_path = os.path.split(filename_w_path)[-1]
-    os.system("convert -density 375 -crop {0} {1}.pdf {2}.png".format(ocr_margins, filename_w_path, os.path.join(output_path, filename_wo_path)))
+    png_root = os.path.join(output_path, "{}-{}".format(filename_wo_path, page))
+    subprocess.run(get_rasterize_command(filename, page, ocr_margins, density) + [png_root],
+                   check=True)
+    return png_root + ".png"
+
+# Environment for tesseract, set to one thread per process when pages are
+# already OCR'd in parallel
+tesseract_env = None
+
+def run_tesseract(arguments, image_data=None):
+    """Run tesseract, raising a RuntimeError with its error output if it fails
+
+    image_data is passed to tesseract's stdin, and its stdout is returned
+
+    """
+    result = subprocess.run(["tesseract"] + arguments, input=image_data,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=tesseract_env)
+    if result.returncode != 0:
+        error = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+        raise RuntimeError("tesseract {} failed with exit code {}: {}".format(
+            ' '.join(arguments), result.returncode, error[-1] if error else ''))
+    return result.stdout
+
+def record_ocr_error(basename, page, error):
+    """Report a page tesseract couldn't OCR and count it in ocr_errors"""
+    print("Couldn't OCR {} page {}: {}".format(basename, page, error))
+    count('ocr_errors', pdf=basename, page=page)
 
 def ocr(filename):
     """OCR a file using tesseract"""
     filename = os.path.splitext(filename)[0]
-    os.system("tesseract {0}.png {0}".format(filename))
+    run_tesseract([filename + ".png", filename])
+
+def ocr_batch(pngs):
+    """OCR a list of images in a single run of tesseract
+
+    tesseract reads the images from a file list, so its models are only loaded
+    once, and separates the text of each image with a form feed.
+
+    Returns the text of each image
+
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        list_path = os.path.join(tmp_dir, "images.txt")
+        with open(list_path, 'w') as outfile:
+            outfile.write(''.join(os.path.abspath(png) + '\n' for png in pngs))
+        output_root = os.path.join(tmp_dir, "text")
+        run_tesseract([list_path, output_root])
+        with open(output_root + ".txt", encoding='utf-8') as infile:
+            text = infile.read()
+    texts = [page_text + '\f' for page_text in text.split('\f')[:-1]]
+    if len(texts) != len(pngs):
+        raise RuntimeError("tesseract returned {} pages of text for {} images".format(
+            len(texts), len(pngs)))
+    return texts
+
+def get_mean_confidence(tsv):
+    """Get the mean confidence (0-100) of the words in tesseract's tsv output"""
+    confidences = []
+    for line in tsv.splitlines()[1:]:
+        fields = line.split('\t')
+        # level 5 rows are words
+        if len(fields) == 12 and fields[0] == '5' and fields[11].strip():
+            confidences.append(float(fields[10]))
+    return sum(confidences) / len(confidences) if confidences else 0.0
+
+def ocr_with_confidence(png):
+    """OCR an image using tesseract and get the mean confidence of its words"""
+    filename = os.path.splitext(png)[0]
+    run_tesseract([png, filename, "txt", "tsv"])
+    with open(filename + ".tsv") as infile:
+        confidence = get_mean_confidence(infile.read())
+    os.remove(filename + ".tsv")
+    return confidence
+
+# Pages OCR'd with more than one density to choose from, along with the
+# (density, seconds, confidence) of each attempt, for the adaptive OCR summary
+adaptive_pages = []
+
+def get_density_setting(densities, min_confidence):
+    """Describe the densities a page is OCR'd at, for the OCR cache key"""
+    if len(densities) == 1:
+        return densities[0]
+    return "{}@{}".format(','.join(str(density) for density in densities), min_confidence)
+
+def record_adaptive_page(basename, page, attempts):
+    """Record the densities tried for a page OCR'd in adaptive mode"""
+    adaptive_pages.append({'pdf': basename, 'page': page, 'attempts': attempts})
+    count('ocr_density', density=attempts[-1][0])
+    if len(attempts) > 1:
+        count('pages_escalated', pdf=basename)
+
+def summarize_adaptive_ocr(pages, densities):
+    """Summarize how many pages needed escalating and the time this saved
 
-def convert_pdf_to_text(pdf_path, output_path, ocr_margins='0x0+0+330'):
+    The time saved is estimated against OCRing every page at the highest
+    density, using the mean time of the attempts made at that density, or
+    scaling by the number of pixels rendered if there weren't any.
+
+    """
+    top_density = densities[-1]
+    attempts = [attempt for page in pages for attempt in page['attempts']]
+    top_times = [seconds for density, seconds, confidence in attempts if density == top_density]
+    if top_times:
+        top_page_seconds = sum(top_times) / len(top_times)
+    elif attempts:
+        pixels = sum(density ** 2 for density, seconds, confidence in attempts)
+        seconds = sum(seconds for density, seconds, confidence in attempts)
+        top_page_seconds = seconds / pixels * top_density ** 2
+    else:
+        top_page_seconds = 0.0
+    seconds = sum(seconds for density, seconds, confidence in attempts)
+    top_seconds = top_page_seconds * len(pages)
+    final_densities = Counter(page['attempts'][-1][0] for page in pages)
+    return {'pages': len(pages),
+            'escalated': sum(len(page['attempts']) > 1 for page in pages),
+            'final_densities': {str(density): final_densities[density] for density in densities},
+            'seconds': seconds,
+            'seconds_at_top_density': top_seconds,
+            'seconds_saved': top_seconds - seconds}
+
+@lru_cache(maxsize=None)
+def get_tesseract_version():
+    """Get the version string reported by tesseract"""
+    version = subprocess.check_output(["tesseract", "--version"],
+                                      stderr=subprocess.STDOUT)
+    return version.decode('utf-8', 'replace').splitlines()[0].strip()
+
+@lru_cache(maxsize=None)
+def get_file_hash(path):
+    """Get the sha256 hash of a file's contents"""
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_ocr_cache_key(pdf_path, page, ocr_margins, density=375):
+    """Get the cache key for the OCR'd text of a single pdf page
+
+    The key covers everything that changes the text tesseract produces: the
+    bytes of the pdf, the page, the crop, the density and tesseract itself.
+
+    """
+    key_parts = [get_file_hash(pdf_path), str(page), ocr_margins, str(density),
+                 'pdftoppm', get_tesseract_version()]
+    return hashlib.sha256('\n'.join(key_parts).encode('utf-8')).hexdigest()
+
+def read_ocr_cache(cache_dir, key, txt_path):
+    """Copy a cached page to txt_path, returning False if it isn't cached"""
+    cached = os.path.join(cache_dir, key + '.txt')
+    try:
+        shutil.copyfile(cached, txt_path)
+    except FileNotFoundError:
+        return False
+    os.utime(cached) # mark as recently used for eviction
+    return True
+
+def write_ocr_cache(cache_dir, key, txt_path):
+    """Store the OCR'd text of a page in the cache"""
+    cached = os.path.join(cache_dir, key + '.txt')
+    os.makedirs(cache_dir, exist_ok=True)
+    shutil.copyfile(txt_path, cached + '.tmp.{}'.format(os.getpid()))
+    os.replace(cached + '.tmp.{}'.format(os.getpid()), cached)
+
+def evict_ocr_cache(cache_dir, max_bytes):
+    """Remove the least recently used pages until the cache fits in max_bytes"""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for path in glob(os.path.join(cache_dir, "*.txt")):
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+def ocr_pdf_page(pdf_path, page, output_path, ocr_margins, cache_dir=None,
+                 densities=(375,), min_confidence=None):
+    """Rasterize and OCR a single page of a pdf
+
+    If cache_dir is provided pages that have already been OCR'd with the same
+    settings are restored from the cache without running pdftoppm or tesseract.
+
+    With more than one density the page is OCR'd at each (increasing) density
+    in turn, stopping at the first where the mean confidence of the words
+    reaches min_confidence.
+
+    If tesseract fails the page is counted in ocr_errors and left out.
+
+    """
+    basename = os.path.splitext(os.path.basename(pdf_path))[0]
+    txt_path = os.path.join(output_path, "{}-{}.txt".format(basename, page))
+    if cache_dir:
+        key = get_ocr_cache_key(pdf_path, page, ocr_margins,
+                                get_density_setting(densities, min_confidence))
+        if read_ocr_cache(cache_dir, key, txt_path):
+            count('ocr_cache_hits', pdf=basename)
+            return
+    try:
+        if len(densities) == 1:
+            with timed('rasterize', pdf=basename, page=page):
+                png = convert_pdf_page_to_image(pdf_path, page, output_path, ocr_margins,
+                                                densities[0])
+            with timed('ocr', pdf=basename, page=page):
+                ocr(png)
+        else:
+            attempts = []
+            for density in densities:
+                start = time.perf_counter()
+                with timed('rasterize', pdf=basename, page=page):
+                    png = convert_pdf_page_to_image(pdf_path, page, output_path,
+                                                    ocr_margins, density)
+                with timed('ocr', pdf=basename, page=page):
+                    confidence = ocr_with_confidence(png)
+                attempts.append((density, time.perf_counter() - start, confidence))
+                if confidence >= min_confidence:
+                    break
+            record_adaptive_page(basename, page, attempts)
+    except RuntimeError as error:
+        record_ocr_error(basename, page, error)
+        return
+    count('pages_ocrd', pdf=basename)
+    if cache_dir and os.path.exists(txt_path):
+        write_ocr_cache(cache_dir, key, txt_path)
+
+def ocr_pdf_pages_batch(pdf_path, pages, output_path, ocr_margins, cache_dir=None,
+                        density=375):
+    """Rasterize several pages of a pdf and OCR them in one run of tesseract
+
+    Pages in the cache are restored from it as in ocr_pdf_page. tesseract
+    doesn't say when each page in a batch finishes, so each page's 'ocr' timing
+    is its share of the batch. If the batch fails its pages are OCR'd one at a
+    time, and any that still fail are counted in ocr_errors and left out.
+
+    """
+    basename = os.path.splitext(os.path.basename(pdf_path))[0]
+    batch = []
+    for page in pages:
+        txt_path = os.path.join(output_path, "{}-{}.txt".format(basename, page))
+        key = None
+        if cache_dir:
+            key = get_ocr_cache_key(pdf_path, page, ocr_margins, density)
+            if read_ocr_cache(cache_dir, key, txt_path):
+                count('ocr_cache_hits', pdf=basename)
+                continue
+        with timed('rasterize', pdf=basename, page=page):
+            png = convert_pdf_page_to_image(pdf_path, page, output_path, ocr_margins,
+                                            density)
+        batch.append((page, png, txt_path, key))
+    if not batch:
+        return
+    start = time.perf_counter()
+    try:
+        texts = ocr_batch([png for _, png, _, _ in batch])
+    except RuntimeError as error:
+        print("Batch OCR of {} pages {}-{} failed, OCRing them one at a time: {}".format(
+            basename, batch[0][0], batch[-1][0], error))
+        texts = None
+    seconds = time.perf_counter() - start
+    instrumentation.add_timing('ocr_batch', seconds, pdf=basename)
+    for position, (page, png, txt_path, key) in enumerate(batch):
+        if texts is not None:
+            instrumentation.add_timing('ocr', seconds / len(batch), pdf=basename, page=page)
+            with open(txt_path, 'w', encoding='utf-8') as outfile:
+                outfile.write(texts[position])
+        else:
+            try:
+                with timed('ocr', pdf=basename, page=page):
+                    ocr(png)
+            except RuntimeError as error:
+                record_ocr_error(basename, page, error)
+                continue
+        count('pages_ocrd', pdf=basename)
+        if cache_dir and os.path.exists(txt_path):
+            write_ocr_cache(cache_dir, key, txt_path)
+
+def convert_pdf_to_text(pdf_path, output_path, ocr_margins='0x0+0+330',
+                        executor=None, cache_dir=None, pages=None,
+                        densities=(375,), min_confidence=None, batch_size=1):
     """Convert a non-OCR'd PDF into text
 
-    Use convert to convert to images and tesseract for OCR
+    Use pdftoppm to convert to images and tesseract for OCR
+
+    If an executor is provided each page is submitted to it as a separate job
+    and the list of futures is returned so that pages from several pdfs can be
+    processed at once. Pages are then looked up in cache_dir first if given.
+
+    If a list of (zero indexed) pages is given only those pages are OCR'd,
+    otherwise every page is. See ocr_pdf_page for densities and min_confidence.
+
+    With a batch_size above 1 and a single density, pages are OCR'd batch_size
+    at a time by ocr_pdf_pages_batch, each batch as one job.
 
     """
-    convert_pdf_to_images(pdf_path, output_path, ocr_margins)
+    if pages is None:
+        pages = range(get_page_count(pdf_path))
+    if batch_size > 1 and len(densities) == 1:
+        pages = list(pages)
+        batches = [pages[start:start + batch_size]
+                   for start in range(0, len(pages), batch_size)]
+        if executor is None:
+            for batch in batches:
+                ocr_pdf_pages_batch(pdf_path, batch, output_path, ocr_margins,
+                                    cache_dir, densities[0])
+            return []
+        return [executor.submit(ocr_pdf_pages_batch, pdf_path, batch, output_path,
+                                ocr_margins, cache_dir, densities[0])
+                for batch in batches]
+    if executor is None:
+        for page in pages:
+            ocr_pdf_page(pdf_path, page, output_path, ocr_margins, cache_dir,
+                         densities, min_confidence)
+        return []
+    return [executor.submit(ocr_pdf_page, pdf_path, page, output_path,
+                            ocr_margins, cache_dir, densities, min_confidence)
+            for page in pages]
+
+def rasterize_pdf_page(filename, page, ocr_margins, density=375):
+    """Render the cropped area of a single page of a pdf to png data in memory"""
+    command = get_rasterize_command(filename, page, ocr_margins, density)
+    return subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+
+def ocr_image_data(image_data):
+    """OCR png data by piping it through tesseract"""
+    return run_tesseract(["stdin", "stdout"], image_data)
 
-    #multi-page pdfs create multiple png files so loop over them
+def ocr_image_data_with_confidence(image_data):
+    """OCR png data with tesseract, returning the text and the mean word confidence"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "page")
+        run_tesseract(["stdin", filename, "txt", "tsv"], image_data)
+        with open(filename + ".txt", 'rb') as infile:
+            text = infile.read()
+        with open(filename + ".tsv") as infile:
+            confidence = get_mean_confidence(infile.read())
+    return text, confidence
+
+def ocr_image_data_adaptive(pdf_path, page, ocr_margins, image_data, densities,
+                            min_confidence):
+    """OCR png data rendered at densities[0], re-rendering at higher densities
+    while the mean word confidence is below min_confidence"""
     basename = os.path.splitext(os.path.basename(pdf_path))[0]
-    pngs = glob(os.path.join(output_path, basename + "*.png"))
-    for png in pngs:
-        ocr(png)
+    attempts = []
+    for position, density in enumerate(densities):
+        start = time.perf_counter()
+        if position > 0:
+            with timed('rasterize', pdf=basename, page=page):
+                image_data = rasterize_pdf_page(pdf_path, page, ocr_margins, density)
+        with timed('ocr', pdf=basename, page=page):
+            text, confidence = ocr_image_data_with_confidence(image_data)
+        attempts.append((density, time.perf_counter() - start, confidence))
+        if confidence >= min_confidence:
+            break
+    record_adaptive_page(basename, page, attempts)
+    return text
 
-def convert_pdf_to_text_no_ocr(pdf_path, output_path):
-    """Convert a pdf to text when no OCR is needed
+def rasterize_pdf_pages(pdf_path, pages, ocr_margins, density=375):
+    """Yield (page, png data) for each page of a pdf
 
-    Uses pdftotext from the shell to do the conversion
+    The next page is rendered in the background while the caller OCRs the
+    current one, so no more than two pages are held in memory at once.
 
     """
-    os.system("pdftotext -f 1 -l 1 -H 560 -W 500 -x 0 -y 90 {} {}".format(pdf_path, "first_page.txt"))
-    os.system("pdftotext -f 2 -H 600 -W 500 -x 0 -y 50 {} {}".format(pdf_path, "other_pages.txt"))
-    os.system("cat first_page.txt other_pages.txt > {}".format(output_path))
-    os.remove("first_page.txt")
-    os.remove("other_pages.txt")
+    with ThreadPoolExecutor(max_workers=1) as rasterizer:
+        pending = None
+        for page in pages:
+            job = rasterizer.submit(rasterize_pdf_page, pdf_path, page,
+                                    ocr_margins, density)
+            if pending:
+                yield pending[0], pending[1].result()
+            pending = (page, job)
+        if pending:
+            yield pending[0], pending[1].result()
+
+def stream_pdf_to_text(pdf_path, output_path, ocr_margins='0x0+0+330', cache_dir=None,
+                       pages=None, densities=(375,), min_confidence=None):
+    """Convert a non-OCR'd PDF into text without writing images to disk
+
+    Each page goes straight from pdftoppm to tesseract in memory and only the
+    text for each page is written, using the same names as convert_pdf_to_text.
+    Pages tesseract fails on are counted in ocr_errors and left out.
 
-def cleanup_nonpara_pages(path, start_page):
-    """Remove text and png files for pages that aren't the core paragraph data"""
-    pages  = range(start_page - 1) #pages are not zero indexed
+    """
+    basename = os.path.splitext(os.path.basename(pdf_path))[0]
+    txt_paths = dict()
+    cache_keys = dict()
+    if pages is None:
+        pages = range(get_page_count(pdf_path))
+    pages_to_ocr = []
     for page in pages:
-        os.remove(os.path.join(path, "BBC{}-{}.txt".format(year, page)))
-        os.remove(os.path.join(path, "BBC{}-{}.png".format(year, page)))
+        txt_paths[page] = os.path.join(output_path, "{}-{}.txt".format(basename, page))
+        if cache_dir:
+            cache_keys[page] = get_ocr_cache_key(pdf_path, page, ocr_margins,
+                                                 get_density_setting(densities, min_confidence))
+            if read_ocr_cache(cache_dir, cache_keys[page], txt_paths[page]):
+                count('ocr_cache_hits', pdf=basename)
+                continue
+        pages_to_ocr.append(page)
+    # rasterizing overlaps with OCR here, so only the time spent waiting for
+    # the next page is recorded as rasterize time
+    start = time.perf_counter()
+    for page, image_data in rasterize_pdf_pages(pdf_path, pages_to_ocr, ocr_margins,
+                                                densities[0]):
+        instrumentation.add_timing('rasterize', time.perf_counter() - start,
+                                   pdf=basename, page=page)
+        try:
+            if len(densities) == 1:
+                with timed('ocr', pdf=basename, page=page):
+                    text = ocr_image_data(image_data)
+            else:
+                text = ocr_image_data_adaptive(pdf_path, page, ocr_margins, image_data,
+                                               densities, min_confidence)
+        except RuntimeError as error:
+            record_ocr_error(basename, page, error)
+            start = time.perf_counter()
+            continue
+        with open(txt_paths[page], 'wb') as outfile:
+            outfile.write(text)
+        count('pages_ocrd', pdf=basename)
+        if cache_dir:
+            write_ocr_cache(cache_dir, cache_keys[page], txt_paths[page])
+        start = time.perf_counter()
+
+# pdftotext crops for the 'fixed' layout of the 2003-2009 issues
+text_layer_crops = {'first_page': "-H 560 -W 500 -x 0 -y 90",
+                    'other_pages': "-H 600 -W 500 -x 0 -y 50"}
+
+def get_text_layer_crop(ocr_margins):
+    """Turn an OCR crop geometry into pdftotext options for the same area in points"""
+    x, y, width, height = get_crop_points(ocr_margins)
+    # pdftotext has no 'rest of the page', so crop past the edge of any page
+    width, height = width or 10000, height or 10000
+    return ["-x", str(round(x)), "-y", str(round(y)),
+            "-W", str(round(width)), "-H", str(round(height))]
+
+def extract_text_layer(pdf_path, page, ocr_margins='0x0+0+330', layout=None):
+    """Get the embedded text of a single (zero indexed) page using pdftotext
+
+    Only the area in ocr_margins, which would otherwise be OCR'd, is read. The
+    'fixed' layout uses the text_layer_crops boxes instead.
+
+    """
+    if layout == 'fixed':
+        crop = text_layer_crops['first_page' if page == 0 else 'other_pages'].split()
+    else:
+        crop = get_text_layer_crop(ocr_margins)
+    command = (["pdftotext", "-f", str(page + 1), "-l", str(page + 1)] +
+               crop + [pdf_path, "-"])
+    text = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    return text.decode('utf-8', 'replace')
+
+def get_crop_points(ocr_margins, density=margins_density):
+    """Turn an OCR crop geometry in pixels at density into (x, y, width, height) in points
+
+    A width or height of 0 keeps the rest of the page, as with get_crop_box
+
+    """
+    return tuple(value * 72 / density for value in parse_geometry(ocr_margins))
+
+def get_positioned_words(pdf_path, page):
+    """Get the words on a single (zero indexed) page with their bounding boxes
+
+    Uses pdftotext -bbox, which gives each word in points from the top left of
+    the page. Returns a list of (x_min, y_min, x_max, y_max, word).
+
+    """
+    command = ["pdftotext", "-bbox", "-f", str(page + 1), "-l", str(page + 1),
+               pdf_path, "-"]
+    html = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    words = []
+    for element in ElementTree.fromstring(html).iter():
+        if element.tag.rsplit('}', 1)[-1] == 'word' and element.text:
+            box = [float(element.get(edge)) for edge in ['xMin', 'yMin', 'xMax', 'yMax']]
+            words.append(tuple(box) + (element.text,))
+    return words
+
+def find_column_bounds(words, min_gap=8, max_crossing=0.02, min_column_words=0.1):
+    """Find the x positions of the gutters between columns of words
+
+    A gutter is a vertical strip at least min_gap points wide crossed by no more
+    than max_crossing of the words, so a heading across the columns doesn't hide
+    it. Each column needs at least min_column_words of the words, so a strip of
+    page numbers or a ragged margin isn't taken for a column.
+
+    """
+    if not words:
+        return []
+    left = int(min(word[0] for word in words))
+    right = int(max(word[2] for word in words)) + 1
+    coverage = [0] * (right - left)
+    for x_min, _, x_max, _, _ in words:
+        for position in range(int(x_min) - left, int(x_max) - left + 1):
+            coverage[position] += 1
+    gaps = []
+    gap_start = None
+    for position, covered in enumerate(coverage + [len(words)]):
+        if covered <= max_crossing * len(words):
+            if gap_start is None:
+                gap_start = position
+        elif gap_start is not None:
+            if position - gap_start >= min_gap and gap_start > 0:
+                gaps.append(left + (gap_start + position) / 2)
+            gap_start = None
+    bounds = []
+    for gap in gaps:
+        previous = bounds[-1] if bounds else float('-inf')
+        column_words = sum(previous <= (word[0] + word[2]) / 2 < gap for word in words)
+        if column_words >= min_column_words * len(words):
+            bounds.append(gap)
+    remaining = sum((word[0] + word[2]) / 2 >= bounds[-1] for word in words) if bounds else 0
+    if bounds and remaining < min_column_words * len(words):
+        bounds.pop()
+    return bounds
+
+def overlaps_line(word, other):
+    """Check if two word boxes overlap vertically by more than half the smaller height"""
+    overlap = min(word[3], other[3]) - max(word[1], other[1])
+    return overlap > min(word[3] - word[1], other[3] - other[1]) / 2
+
+def group_lines(words):
+    """Group words into lines of text, top to bottom, each read left to right
+
+    Words are on the same line when their boxes overlap by more than half of the
+    smaller height. Returns a list of (y_min, text).
+
+    """
+    lines = []
+    for word in sorted(words, key=lambda word: (word[1] + word[3]) / 2):
+        if lines:
+            line_words, y_min, y_max = lines[-1]
+            if overlaps_line(word, (0, y_min, 0, y_max)):
+                line_words.append(word)
+                lines[-1] = (line_words, min(y_min, word[1]), max(y_max, word[3]))
+                continue
+        lines.append(([word], word[1], word[3]))
+    return [(y_min, ' '.join(word[4] for word in sorted(line_words)))
+            for line_words, y_min, _ in lines]
+
+def get_crossing_words(words, bounds, min_gap=8):
+    """Get the words that cross a gutter or sit either side of it on one line
+
+    Words either side of a gutter closer together than min_gap are on a line
+    across it, e.g. a heading with a space between words where the gutter is
+
+    """
+    crossing = []
+    for bound in bounds:
+        crossing.extend(word for word in words if word[0] < bound < word[2])
+        left = [word for word in words if bound - min_gap < word[2] <= bound]
+        right = [word for word in words if bound <= word[0] < bound + min_gap]
+        for left_word in left:
+            for right_word in right:
+                if (right_word[0] - left_word[2] < min_gap and
+                        overlaps_line(left_word, right_word)):
+                    crossing.extend([left_word, right_word])
+    return crossing
+
+def rebuild_reading_order(words, min_gap=8, bounds=None):
+    """Rebuild the text of a page from its words, reading each column in turn
+
+    Lines across a gutter, such as headings across the page, split the page into
+    sections, and the columns of each section are read left to right before the
+    line after it. bounds are found with find_column_bounds if not given.
+
+    """
+    if bounds is None:
+        bounds = find_column_bounds(words, min_gap)
+    crossing = get_crossing_words(words, bounds, min_gap)
+    spanning = []
+    columns = [[] for _ in range(len(bounds) + 1)]
+    for word in words:
+        if any(overlaps_line(word, other) for other in crossing):
+            spanning.append(word)
+        else:
+            center = (word[0] + word[2]) / 2
+            columns[sum(center >= bound for bound in bounds)].append(word)
+    spanning_lines = group_lines(spanning)
+    column_lines = [group_lines(column) for column in columns]
+    text_lines = []
+    section_top = float('-inf')
+    for section_bottom, spanning_text in spanning_lines + [(float('inf'), None)]:
+        for lines in column_lines:
+            text_lines.extend(text for y_min, text in lines
+                              if section_top <= y_min < section_bottom)
+        if spanning_text is not None:
+            text_lines.append(spanning_text)
+        section_top = section_bottom
+    return '\n'.join(text_lines) + '\n\f'
+
+def extract_text_layer_columns(pdf_path, page, ocr_margins='0x0+0+330'):
+    """Get the embedded text of a single (zero indexed) multi-column page
+
+    Only the words in the area that would be OCR'd are kept, and the columns
+    are found and read in order by rebuild_reading_order. Returns None if no
+    gutter is found, e.g. when a table or figure crosses it, since reading the
+    page a line at a time would interleave the columns again.
+
+    """
+    x, y, width, height = get_crop_points(ocr_margins)
+    right = x + width if width else float('inf')
+    bottom = y + height if height else float('inf')
+    words = [word for word in get_positioned_words(pdf_path, page)
+             if x <= word[0] and word[2] <= right and y <= word[1] and word[3] <= bottom]
+    bounds = find_column_bounds(words)
+    if not bounds:
+        return None
+    return rebuild_reading_order(words, bounds=bounds)
+
+def is_word_like(token):
+    """Check if a token is mostly letters and digits, as real text is"""
+    alphanumeric = sum(character.isalnum() for character in token)
+    return alphanumeric >= len(token) / 2 and '\ufffd' not in token and 'cid:' not in token
+
+def score_text_layer(text, min_chars=100):
+    """Score how usable a page's text layer is, from 0 to 1
+
+    The score is the fraction of tokens that look like words or numbers.
+    Garbled font encodings give mostly symbols, unknown characters or (cid:N)
+    codes and score low. Pages with less than min_chars of text, such as scans
+    without a text layer, score 0.
+
+    """
+    tokens = text.split()
+    if sum(len(token) for token in tokens) < min_chars:
+        return 0.0
+    return sum(is_word_like(token) for token in tokens) / len(tokens)
+
+def route_pdf_pages(pdf_path, output_path, pages, min_score=0.8, layout=None,
+                    ocr_margins='0x0+0+330'):
+    """Save the text layer of pages where it's usable and list the rest for OCR
+
+    Pages whose text layer scores at least min_score are written straight to
+    the page text files that OCR would produce, e.g. BBC1988-0.txt. Returns the
+    (zero indexed) pages that need OCR. With a min_score of 0 every page uses
+    its text layer.
+
+    With a layout of 'columns' the text is rebuilt column by column from the
+    positions of the words in the ocr_margins area by extract_text_layer_columns,
+    and pages where no columns are found are always OCR'd.
+
+    """
+    basename = os.path.splitext(os.path.basename(pdf_path))[0]
+    ocr_pages = []
+    for page in pages:
+        with timed('text_layer', pdf=basename, page=page):
+            if layout == 'columns':
+                text = extract_text_layer_columns(pdf_path, page, ocr_margins)
+            else:
+                text = extract_text_layer(pdf_path, page, ocr_margins, layout)
+        if text is None:
+            count('text_layer_no_columns', pdf=basename)
+            ocr_pages.append(page)
+            continue
+        score = score_text_layer(text)
+        count('text_layer_scores', score=round(score, 1))
+        if score >= min_score:
+            txt_path = os.path.join(output_path, "{}-{}.txt".format(basename, page))
+            with open(txt_path, 'w') as outfile:
+                outfile.write(text)
+            count('text_layer_pages', pdf=basename)
+        else:
+            ocr_pages.append(page)
+    return ocr_pages
+
+def cleanup_nonpara_pages(path, year, pages):
+    """Remove text and png files for pages that aren't the core paragraph data
+
+    Pages outside the page range are never converted, but files for them can
+    be left from runs with an earlier range and would end up in the combined
+    file.
+
+    """
+    for filename in glob(os.path.join(path, "BBC{}-*".format(year))):
+        page = re.fullmatch(r'BBC[0-9]{4}-([0-9]+)\.(?:txt|png)', os.path.basename(filename))
+        if page and int(page.group(1)) not in pages:
+            os.remove(filename)
 
 def combine_txt_files(path, year):
     """Combine multiple text files into a single file for a given year
 
     File names have the general format: BBC1988-0.txt
-    
+
+    The pages are streamed into the combined file and an index of where each
+    page and site starts is written next to it, see combined_files.py
+
     """
-    with open(os.path.join(path, "bbc_combined_{}.txt".format(year)), 'w') as outfile:
-        filenames = glob(os.path.join(path, "BBC{}*.txt".format(year)))
-        sorted_filenames = sorted_nicely(filenames)
-        for fname in sorted_filenames:
-            with open(fname) as infile:
-                outfile.write(infile.read())
+    filenames = glob(os.path.join(path, "BBC{}*.txt".format(year)))
+    sorted_filenames = sorted_nicely(filenames)
+    combine_pages(sorted_filenames, os.path.join(path, "bbc_combined_{}.txt".format(year)))
 
 def sorted_nicely(l): 
     """ Sort the given iterable in the way that humans expect.
@@ -75,32 +783,126 @@ para_starts = {1988: 4, 1989: 6, 1990: 6, 1991: 7,
 pdf_dir = "./pdfs/"
 data_dir = "./data/"
 
-pdf_info = {1988: {'ocr': True, 'start_page': 4, 'ocr_margins': '0x0+0+375'},
-            1989: {'ocr': True, 'start_page': 6},
-            1990: {'ocr': True, 'start_page': 6},
-            1991: {'ocr': True, 'start_page': 7, 'ocr_margins': '0x0+0+375'},
-            1992: {'ocr': True, 'start_page': 7, 'ocr_margins': '0x0+0+375'},
-            1993: {'ocr': True, 'start_page': 7, 'ocr_margins': '0x0+0+350'},
-            1994: {'ocr': True, 'start_page': 7, 'ocr_margins': '0x0+0+375'},
-            1995: {'ocr': True, 'start_page': 6},
-            2003: {'ocr': False, 'start_page': 1},
-            2004: {'ocr': False, 'start_page': 1},
-            2005: {'ocr': False, 'start_page': 1},
-            # 2006 Needs OCR because column encoding is broken
-            2006: {'ocr': True, 'start_page': 1, 'ocr_margins': '3000x3000+0+350'},
-            2007: {'ocr': False, 'start_page': 1},
-            2008: {'ocr': False, 'start_page': 1},
-            2009: {'ocr': False, 'start_page': 1}}
-
-for year in pdf_info:
-    pdf_path = os.path.join(pdf_dir, "BBC{}.pdf".format(year))
-    if pdf_info[year]['ocr']:
-        if 'ocr_margins' in pdf_info[year]:
-            convert_pdf_to_text(pdf_path, data_dir, pdf_info[year]['ocr_margins'])
-        else:
-            convert_pdf_to_text(pdf_path, data_dir)
-        cleanup_nonpara_pages(data_dir, pdf_info[year]['start_page'])
-        combine_txt_files(data_dir, year)
+# Only pages from 'start_page' to the optional 'end_page', leaving out any
+# 'excluded_pages', are converted (numbered from 1). By default the text layer
+# of each page is scored and only pages where it's missing or garbled are
+# OCR'd. 'ocr': True OCRs every page and 'ocr': False uses every text layer.
+# Text layers are read from the 'ocr_margins' area, except with 'layout':
+# 'fixed', which uses the text_layer_crops boxes the 2003-2009 issues were
+# set up with. 'layout': 'columns' rebuilds the reading order of multi-column
+# pages from the positions of their words instead of using pdftotext's order.
+pdf_info = {1988: {'start_page': 4, 'ocr_margins': '0x0+0+375'},
+            1989: {'start_page': 6},
+            1990: {'start_page': 6},
+            1991: {'start_page': 7, 'ocr_margins': '0x0+0+375'},
+            1992: {'start_page': 7, 'ocr_margins': '0x0+0+375'},
+            1993: {'start_page': 7, 'ocr_margins': '0x0+0+350'},
+            1994: {'start_page': 7, 'ocr_margins': '0x0+0+375'},
+            1995: {'start_page': 6},
+            2003: {'layout': 'fixed', 'start_page': 1},
+            2004: {'layout': 'fixed', 'start_page': 1},
+            2005: {'layout': 'fixed', 'start_page': 1},
+            # 2006's columns are interleaved in the text layer, which doesn't
+            # show up in the text layer score
+            2006: {'layout': 'columns', 'start_page': 1,
+                   'ocr_margins': '3000x3000+0+350'},
+            2007: {'layout': 'fixed', 'start_page': 1},
+            2008: {'layout': 'fixed', 'start_page': 1},
+            2009: {'layout': 'fixed', 'start_page': 1}}
+
+def get_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Convert BBC pdfs to text")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help="number of pages to rasterize and OCR at once "
+                             "(default: number of cores)")
+    parser.add_argument('--stream', action='store_true',
+                        help="pipe pages from pdftoppm to tesseract without "
+                             "writing images to disk; --jobs then sets the "
+                             "number of pdfs streamed at once")
+    parser.add_argument('--cache-dir', default="./cache/ocr/",
+                        help="directory for cached OCR'd pages (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="OCR every page even if it has been cached")
+    parser.add_argument('--cache-size', type=int, default=500,
+                        help="maximum size of the OCR cache in MB (default: %(default)s)")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="OCR each page at the lowest of --densities whose words "
+                             "reach --min-confidence instead of always at 375 dpi")
+    parser.add_argument('--densities', type=int, nargs='+', default=[200, 300, 375],
+                        help="densities to try in adaptive mode (default: %(default)s)")
+    parser.add_argument('--min-confidence', type=float, default=80,
+                        help="mean tesseract word confidence (0-100) a page needs "
+                             "before it stops being re-rendered at a higher "
+                             "density in adaptive mode (default: %(default)s)")
+    parser.add_argument('--min-text-score', type=float, default=0.8,
+                        help="OCR pages whose text layer scores below this, from 0 "
+                             "(missing or garbled) to 1 (default: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=10,
+                        help="number of pages OCR'd by each run of tesseract, "
+                             "except with --stream or --adaptive (default: %(default)s)")
+    parser.add_argument('--report', default="./reports/convert-pdfs-to-txt.json",
+                        help="file to write the timings and counters to (default: %(default)s)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    run_start = time.perf_counter()
+    cache_dir = None if args.no_cache else args.cache_dir
+    densities = sorted(args.densities) if args.adaptive else [375]
+    if args.jobs > 1:
+        tesseract_env = dict(os.environ, OMP_THREAD_LIMIT='1')
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # Queue the pages that need OCR from each year as soon as its text
+        # layers have been checked so that the pool stays busy across years
+        ocr_jobs = dict()
+        year_pages = dict()
+        for year in pdf_info:
+            pdf_path = os.path.join(pdf_dir, "BBC{}.pdf".format(year))
+            year_pages[year] = get_pdf_pages(pdf_path, pdf_info[year])
+            ocr_margins = pdf_info[year].get('ocr_margins', '0x0+0+330')
+            pages = year_pages[year]
+            layout = pdf_info[year].get('layout')
+            if 'ocr' not in pdf_info[year]:
+                pages = route_pdf_pages(pdf_path, data_dir, pages, args.min_text_score,
+                                        layout, ocr_margins)
+            elif not pdf_info[year]['ocr']:
+                pages = route_pdf_pages(pdf_path, data_dir, pages, 0, layout,
+                                        ocr_margins)
+            if pages:
+                if args.stream:
+                    ocr_jobs[year] = [executor.submit(stream_pdf_to_text, pdf_path,
+                                                      data_dir, ocr_margins,
+                                                      cache_dir, pages, densities,
+                                                      args.min_confidence)]
+                else:
+                    ocr_jobs[year] = convert_pdf_to_text(pdf_path, data_dir,
+                                                         ocr_margins, executor,
+                                                         cache_dir, pages, densities,
+                                                         args.min_confidence,
+                                                         args.batch_size)
+        for year in pdf_info:
+            for job in ocr_jobs.get(year, []):
+                job.result()
+            with timed('combine', pdf="BBC{}".format(year)):
+                cleanup_nonpara_pages(data_dir, year, year_pages[year])
+                combine_txt_files(data_dir, year)
+    if cache_dir:
+        evict_ocr_cache(cache_dir, args.cache_size * 1024 * 1024)
+    instrumentation.add_timing('run', time.perf_counter() - run_start)
+    ocr_errors = instrumentation.get_report()['counters'].get('ocr_errors', {})
+    if ocr_errors:
+        print("{} pages couldn't be OCR'd, see ocr_errors in the report".format(
+            ocr_errors['total']))
+    if args.adaptive:
+        summary = summarize_adaptive_ocr(adaptive_pages, densities)
+        print("Adaptive OCR: {} of {} pages needed a higher density; {:.0f}s spent "
+              "against about {:.0f}s at {} dpi, saving {:.0f}s".format(
+                  summary['escalated'], summary['pages'], summary['seconds'],
+                  summary['seconds_at_top_density'], densities[-1],
+                  summary['seconds_saved']))
+        instrumentation.write_report(args.report, adaptive_ocr=summary,
+                                     adaptive_pages=adaptive_pages)
     else:
-        output_file_path = os.path.join(data_dir, "bbc_combined_{}.txt".format(year))
-        convert_pdf_to_text_no_ocr(pdf_path, output_file_path)
+        instrumentation.write_report(args.report)
+    print("Timings and counters written to {}".format(args.report))
@@ -0,0 +1,169 @@
+"""Compare two sets of tables written by bbc-text-mining.py
+
+siteIDs are renumbered when sites are linked differently, so rows are matched
+on their natural keys instead: siteNumInCensus (which includes the year) for
+censuses and sites, and siteNumInCensus, year, species and status for counts.
+Added, removed and changed rows are written to a CSV, one line per changed
+field, and the number of changes to each field is printed, e.g.:
+
+python diff_tables.py BBC_pdfs/ output/
+
+Values that are both numbers are compared as numbers, so 1937 and 1937.0 are
+the same.
+
+"""
+
+import argparse
+import csv
+import os
+import time
+
+import pandas as pd
+
+table_keys = {'counts': ['siteNumInCensus', 'year', 'species', 'status'],
+              'censuses': ['siteNumInCensus'],
+              'sites': ['siteNumInCensus']}
+change_key_columns = table_keys['counts'] + ['occurrence']
+numeric_keys = ['siteID', 'siteNumInCensus', 'year']
+
+def add_site_nums(tables):
+    """Add siteNumInCensus to the counts and sites tables from the census table
+
+    Counts are joined on siteID and year. The sites table has a row for each
+    site-year in the same order as the census table once that is sorted by
+    siteID, so the rows are matched up by position.
+
+    """
+    censuses = tables['censuses']
+    census_keys = censuses[['siteID', 'year', 'siteNumInCensus']]
+    tables['counts'] = pd.merge(tables['counts'], census_keys, on=['siteID', 'year'],
+                                how='left', sort=False)
+    ordered = censuses.sort_values('siteID', kind='stable')
+    sites = tables['sites']
+    if len(sites) != len(ordered) or (sites['siteID'].values != ordered['siteID'].values).any():
+        raise ValueError("The sites table doesn't have a row for each row of the census table")
+    tables['sites'] = sites.assign(siteNumInCensus=ordered['siteNumInCensus'].values)
+    return tables
+
+def load_tables(directory):
+    """Load the counts, censuses and sites tables from a directory as text
+
+    The numeric keys are turned into integers, as older tables wrote them as
+    floats, e.g. 11988.0
+
+    """
+    tables = dict()
+    for table in table_keys:
+        tables[table] = pd.read_csv(os.path.join(directory, 'bbc_{}.csv'.format(table)),
+                                    dtype=str, keep_default_na=False)
+        for column in numeric_keys:
+            if column in tables[table]:
+                tables[table][column] = pd.to_numeric(tables[table][column]).astype('Int64')
+    return add_site_nums(tables)
+
+def get_keyed(table, keys):
+    """Index a table on its keys
+
+    A key that appears more than once, e.g. a species listed twice in a site, is
+    told apart by the order it appears in
+
+    """
+    occurrence = table.groupby(keys, sort=False).cumcount()
+    return table.assign(occurrence=occurrence).set_index(keys + ['occurrence'])
+
+def get_changed(old_values, new_values):
+    """Find where two columns of text differ, comparing values that are both numbers as numbers"""
+    old_numbers = pd.to_numeric(old_values, errors='coerce')
+    new_numbers = pd.to_numeric(new_values, errors='coerce')
+    both_numbers = old_numbers.notna() & new_numbers.notna()
+    return ((both_numbers & (old_numbers != new_numbers)) |
+            (~both_numbers & (old_values != new_values)))
+
+def diff_table(old, new, keys):
+    """Compare two versions of a table on their keys
+
+    Returns the keys of the added and removed rows and, for each field, a data
+    frame of the changed values indexed on the keys
+
+    """
+    old = get_keyed(old, keys)
+    new = get_keyed(new, keys)
+    added = new.index.difference(old.index)
+    removed = old.index.difference(new.index)
+    shared = old.index.intersection(new.index)
+    old_shared = old.loc[shared]
+    new_shared = new.loc[shared]
+    changes = dict()
+    for column in old.columns.intersection(new.columns):
+        if column == 'siteID':
+            continue
+        changed = get_changed(old_shared[column], new_shared[column])
+        if changed.any():
+            changes[column] = pd.DataFrame({'old': old_shared[column][changed],
+                                            'new': new_shared[column][changed]})
+    return added, removed, changes
+
+def get_key_fields(keys, key):
+    """Get the key columns of a line of the changes file, blank if not in keys"""
+    key = dict(zip(keys + ['occurrence'], key))
+    return [key.get(column, '') for column in change_key_columns]
+
+def write_changes(writer, table, keys, added, removed, changes):
+    """Write a line for each added or removed row and each changed field"""
+    for change, rows in [('added', added), ('removed', removed)]:
+        for key in rows:
+            writer.writerow([table, change] + get_key_fields(keys, key) + ['', '', ''])
+    for column, values in changes.items():
+        for key, old_value, new_value in zip(values.index, values['old'], values['new']):
+            writer.writerow([table, 'changed'] + get_key_fields(keys, key) +
+                            [column, old_value, new_value])
+
+def diff_tables(old_dir, new_dir, changes_file):
+    """Compare the tables in two directories, writing the changes to changes_file
+
+    Returns a summary of the changes to each table
+
+    """
+    old_tables = load_tables(old_dir)
+    new_tables = load_tables(new_dir)
+    summary = dict()
+    os.makedirs(os.path.dirname(changes_file) or '.', exist_ok=True)
+    with open(changes_file, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(['table', 'change'] + change_key_columns + ['field', 'old', 'new'])
+        for table, keys in table_keys.items():
+            added, removed, changes = diff_table(old_tables[table], new_tables[table], keys)
+            write_changes(writer, table, keys, added, removed, changes)
+            summary[table] = {'old_rows': len(old_tables[table]),
+                              'new_rows': len(new_tables[table]),
+                              'added': len(added), 'removed': len(removed),
+                              'changed_rows': len(set().union(
+                                  *[values.index for values in changes.values()])),
+                              'changed_fields': {column: len(values)
+                                                 for column, values in changes.items()}}
+    return summary
+
+def get_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Compare two sets of BBC tables")
+    parser.add_argument('old_dir', nargs='?', default="./BBC_pdfs/",
+                        help="directory with the reference tables (default: %(default)s)")
+    parser.add_argument('new_dir', nargs='?', default="./output/",
+                        help="directory with the new tables (default: %(default)s)")
+    parser.add_argument('--changes', default="./reports/table-changes.csv",
+                        help="file to write the changed rows to (default: %(default)s)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    start = time.perf_counter()
+    summary = diff_tables(args.old_dir, args.new_dir, args.changes)
+    for table, table_summary in summary.items():
+        print("{}: {} -> {} rows, {} added, {} removed, {} changed".format(
+            table, table_summary['old_rows'], table_summary['new_rows'],
+            table_summary['added'], table_summary['removed'], table_summary['changed_rows']))
+        for column, changed in sorted(table_summary['changed_fields'].items(),
+                                      key=lambda item: -item[1]):
+            print("    {}: {}".format(column, changed))
+    print("Changes written to {} in {:.2f}s".format(args.changes,
+                                                   time.perf_counter() - start))
@@ -0,0 +1,115 @@
+"""Record timings and counters for a run and write them out as a JSON report
+
+Stages are timed with the timed() context manager and events are counted with
+count(). Keyword labels such as year=1988 or site=3 break each total down
+further. Each process keeps its own report, so reports from worker processes
+are returned to the main process and combined with merge_report.
+
+"""
+
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+report = {'timings': {}, 'counters': {}}
+profiler = None
+_lock = threading.Lock()
+_profile_state = threading.local()
+
+def get_label(labels):
+    """Turn keyword labels into the key used in the report, e.g. year=1988,site=3"""
+    return ','.join('{}={}'.format(name, value) for name, value in labels.items())
+
+def add_timing(stage, seconds, **labels):
+    """Add a timing for a stage to its total and to its labelled entry"""
+    with _lock:
+        stage_timings = report['timings'].setdefault(stage, dict())
+        for label in {'total', get_label(labels) or 'total'}:
+            calls, total_seconds = stage_timings.get(label, (0, 0.0))
+            stage_timings[label] = (calls + 1, total_seconds + seconds)
+
+@contextmanager
+def timed(stage, **labels):
+    """Time the code inside the with block as a stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(stage, time.perf_counter() - start, **labels)
+
+def count(name, amount=1, **labels):
+    """Add to a counter and to its labelled entry"""
+    with _lock:
+        counters = report['counters'].setdefault(name, dict())
+        for label in {'total', get_label(labels) or 'total'}:
+            counters[label] = counters.get(label, 0) + amount
+
+def reset_report():
+    """Clear all timings and counters"""
+    with _lock:
+        report['timings'].clear()
+        report['counters'].clear()
+
+def get_report():
+    """Get a copy of the current timings and counters"""
+    with _lock:
+        return {'timings': {stage: dict(timings) for stage, timings in report['timings'].items()},
+                'counters': {name: dict(counters) for name, counters in report['counters'].items()}}
+
+def merge_report(other):
+    """Add the timings and counters from another process's report"""
+    with _lock:
+        for stage, timings in other['timings'].items():
+            stage_timings = report['timings'].setdefault(stage, dict())
+            for label, (calls, seconds) in timings.items():
+                old_calls, old_seconds = stage_timings.get(label, (0, 0.0))
+                stage_timings[label] = (old_calls + calls, old_seconds + seconds)
+        for name, counters in other['counters'].items():
+            merged = report['counters'].setdefault(name, dict())
+            for label, amount in counters.items():
+                merged[label] = merged.get(label, 0) + amount
+
+def write_report(path, **extra):
+    """Write the timings, counters and any extra sections to a JSON file"""
+    run_report = get_report()
+    run_report['timings'] = {stage: {label: {'calls': calls, 'seconds': seconds}
+                                     for label, (calls, seconds) in timings.items()}
+                             for stage, timings in run_report['timings'].items()}
+    run_report.update(extra)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as outfile:
+        json.dump(run_report, outfile, indent=2, default=str)
+
+def start_profiling():
+    """Start collecting cProfile data for functions decorated with profiled"""
+    global profiler
+    profiler = cProfile.Profile()
+
+def profiled(func):
+    """Run func under the profiler when profiling has been started
+
+    Only the outermost profiled call in a thread turns the profiler on, so hot
+    functions that call each other can all be decorated.
+
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if profiler is None or getattr(_profile_state, 'active', False):
+            return func(*args, **kwargs)
+        _profile_state.active = True
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            _profile_state.active = False
+    return wrapper
+
+def write_profile(path):
+    """Save the profile data so it can be read with pstats or snakeviz"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    profiler.dump_stats(path)